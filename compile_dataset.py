@@ -0,0 +1,68 @@
+"""Packs the samples listed in opts.data.files into memory-mapped shards,
+one {mode}_{domain} directory per loader, to be used with data.shards.use: true
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+
+from omnigan.data import OmniListDataset
+from omnigan.shards import compile_shards
+from omnigan.utils import load_opts
+
+
+def parsed_args():
+    """Parse and returns command-line args
+
+    Returns:
+        argparse.Namespace: the parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--config",
+        default="./shared/trainer/defaults.yaml",
+        type=str,
+        help="What configuration file to use to overwrite default",
+    )
+    parser.add_argument(
+        "--default_config",
+        default="./shared/trainer/defaults.yaml",
+        type=str,
+        help="What default file to use",
+    )
+    parser.add_argument(
+        "--output_dir",
+        default=None,
+        type=str,
+        help="Where to write the shards, defaults to opts.data.shards.path",
+    )
+    parser.add_argument(
+        "--shard_size",
+        default=None,
+        type=int,
+        help="Maximum shard size in MB, defaults to opts.data.shards.size",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parsed_args()
+    opts = load_opts(args.config, default=args.default_config)
+
+    output_dir = args.output_dir or opts.data.shards.path
+    if not output_dir:
+        raise ValueError("Specify --output_dir or data.shards.path")
+    shard_size = args.shard_size or opts.data.shards.size or 1024
+
+    for mode in ["train", "val"]:
+        for domain in opts.domains:
+            if domain not in opts.data.files[mode]:
+                continue
+            dataset = OmniListDataset(mode, domain, opts)
+            root = Path(output_dir) / "{}_{}".format(mode, domain)
+            print(
+                "Packing {} samples from {} into {}".format(
+                    len(dataset), dataset.file_list_path, root
+                )
+            )
+            n = compile_shards(dataset.samples_paths, root, shard_size)
+            print("  {} shard(s) written".format(n))
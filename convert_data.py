@@ -0,0 +1,158 @@
+"""Converts the samples listed in opts.data.files to formats which are faster to
+load. The datasets use the converted files automatically when they exist:
+
+* --depth: decodes and normalizes the simulated domain's Unity depth maps once
+  and stores them as float16 .depth.npy arrays next to the original files,
+  used if every listed depth map has one
+* --masks: bit-packs masks as .npz files next to the original ones and writes
+  a {list}_packed.json (or .jsonl, .yaml) file list using them, to be used in
+  opts.data.files
+"""
+import json
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+
+from omnigan.data import (
+    OmniListDataset,
+    depth_store_path,
+    write_depth_store,
+    write_packed_mask,
+)
+from omnigan.manifest import read_file_list, write_json_lines
+from omnigan.utils import load_opts
+
+
+def parsed_args():
+    """Parse and returns command-line args
+
+    Returns:
+        argparse.Namespace: the parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--config",
+        default="./shared/trainer/defaults.yaml",
+        type=str,
+        help="What configuration file to use to overwrite default",
+    )
+    parser.add_argument(
+        "--default_config",
+        default="./shared/trainer/defaults.yaml",
+        type=str,
+        help="What default file to use",
+    )
+    parser.add_argument(
+        "--depth", action="store_true", help="Precompute the s domain's depth maps",
+    )
+    parser.add_argument(
+        "--masks", action="store_true", help="Bit-pack the masks",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Convert files even if they have already been converted",
+    )
+    parser.add_argument(
+        "--num_threads", default=8, type=int, help="Files converted in parallel",
+    )
+
+    return parser.parse_args()
+
+
+def is_up_to_date(converted, path):
+    return converted.exists() and converted.stat().st_mtime >= os.stat(path).st_mtime
+
+
+def convert_depth(path, overwrite=False):
+    """Writes path's depth store unless an up-to-date one exists
+
+    Returns:
+        bool: whether the depth map was converted
+    """
+    if not overwrite and is_up_to_date(depth_store_path(path), path):
+        return False
+    write_depth_store(path)
+    return True
+
+
+def convert_mask(path, overwrite=False):
+    """Writes path's bit-packed mask unless an up-to-date one exists
+
+    Returns:
+        str: path to the packed mask
+    """
+    packed = Path(path).with_suffix(".npz")
+    if overwrite or not is_up_to_date(packed, path):
+        write_packed_mask(path)
+    return str(packed)
+
+
+def pack_masks(file_list_path, num_threads=8, overwrite=False):
+    """Bit-packs the masks of a file list and writes the list using them
+
+    Args:
+        file_list_path (str): json, json lines or yaml file list
+        num_threads (int, optional): masks packed in parallel. Defaults to 8.
+        overwrite (bool, optional): pack up-to-date masks again. Defaults to False.
+
+    Returns:
+        pathlib.Path: path to the new file list
+    """
+    file_list_path = Path(file_list_path)
+    samples = list(read_file_list(file_list_path))
+
+    to_pack = [s for s in samples if "m" in s and Path(s["m"]).suffix != ".npz"]
+    print("Packing {} masks from {}".format(len(to_pack), file_list_path))
+    with ThreadPoolExecutor(num_threads) as executor:
+        packed = executor.map(lambda s: convert_mask(s["m"], overwrite), to_pack)
+        for sample, packed_path in zip(to_pack, packed):
+            sample["m"] = packed_path
+
+    packed_list_path = file_list_path.parent / "{}_packed{}".format(
+        file_list_path.stem, file_list_path.suffix
+    )
+    if file_list_path.suffix == ".jsonl":
+        write_json_lines(samples, packed_list_path)
+    else:
+        with open(packed_list_path, "w") as f:
+            if file_list_path.suffix == ".json":
+                json.dump(samples, f)
+            else:
+                yaml.safe_dump(samples, f)
+    print("  Use {} in opts.data.files".format(packed_list_path))
+    return packed_list_path
+
+
+if __name__ == "__main__":
+    args = parsed_args()
+    opts = load_opts(args.config, default=args.default_config)
+
+    if not (args.depth or args.masks):
+        print("Nothing to convert, use --depth and/or --masks")
+
+    for mode in ["train", "val"]:
+        if args.depth and "s" in opts.data.files[mode] and "d" in opts.tasks:
+            dataset = OmniListDataset(mode, "s", opts)
+            paths = [sample["d"] for sample in dataset.samples_paths]
+            print(
+                "Converting {} depth maps from {}".format(
+                    len(paths), dataset.file_list_path
+                )
+            )
+            with ThreadPoolExecutor(args.num_threads) as executor:
+                converted = executor.map(
+                    lambda p: convert_depth(p, args.overwrite), paths
+                )
+                print("  {} converted".format(sum(converted)))
+
+        if args.masks:
+            for domain in opts.domains:
+                if domain in opts.data.files[mode]:
+                    dataset = OmniListDataset(mode, domain, opts)
+                    pack_masks(
+                        dataset.file_list_path, args.num_threads, args.overwrite
+                    )
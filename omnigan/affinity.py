@@ -0,0 +1,174 @@
+"""Core and NUMA-node placement of the DataLoader workers and of the trainer.
+
+Available cores are ordered by NUMA node, starting with opts.data.loaders.
+affinity.numa_node (the GPU's node). The trainer's intra-op thread pool gets
+the first cores, DataLoader workers are pinned to the following ones and only
+use one thread each, so that they don't oversubscribe the trainer's cores.
+"""
+import os
+from pathlib import Path
+
+import torch
+
+
+def parse_cpulist(cpulist):
+    """Parses a Linux cpu list like "0-3,8,10-11"
+
+    Args:
+        cpulist (str): the cpu list
+
+    Returns:
+        list: sorted cpu ids
+    """
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def format_cpulist(cpus):
+    """Inverse of parse_cpulist
+
+    Args:
+        cpus (iterable): cpu ids
+
+    Returns:
+        str: the cpu list
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else "{}-{}".format(first, last)
+        for first, last in ranges
+    )
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes():
+    """Cores this process may use, per NUMA node
+
+    Returns:
+        dict: {node id: sorted cpu ids}, a single node 0 if the topology is unknown
+    """
+    available = set(available_cpus())
+    nodes = {}
+    for node in Path("/sys/devices/system/node").glob("node[0-9]*"):
+        try:
+            cpus = parse_cpulist((node / "cpulist").read_text())
+        except OSError:
+            continue
+        cpus = [cpu for cpu in cpus if cpu in available]
+        if cpus:
+            nodes[int(node.name[len("node") :])] = cpus
+    return nodes or {0: sorted(available)}
+
+
+def get_affinity_layout(opts):
+    """Splits the available cores between the trainer and the training
+    loaders' workers, see the module's docstring
+
+    Args:
+        opts (addict.Dict): options
+
+    Returns:
+        dict: {"nodes": numa_nodes(), "trainer": cpus, "workers": cpus,
+            "num_workers": total number of training workers}
+    """
+    conf = opts.data.loaders.affinity
+    nodes = numa_nodes()
+    first = conf.get("numa_node") or 0
+    order = sorted(nodes, key=lambda node: (node != first, node))
+    cpus = [cpu for node in order for cpu in nodes[node]]
+
+    n_loaders = 1
+    if not opts.data.loaders.get("unified", False):
+        n_loaders = len(
+            [d for d in opts.domains if d in opts.data.files.get("train", {})]
+        )
+    num_workers = opts.data.loaders.get("num_workers", 8) * max(n_loaders, 1)
+
+    trainer_cores = conf.get("trainer_cores") or max(1, len(cpus) - num_workers)
+    if num_workers > 0:
+        # keep at least one core for the workers
+        trainer_cores = min(trainer_cores, max(len(cpus) - 1, 1))
+    trainer = cpus[:trainer_cores]
+    workers = cpus[trainer_cores:] or cpus
+    return {
+        "nodes": nodes,
+        "trainer": trainer,
+        "workers": workers,
+        "num_workers": num_workers,
+    }
+
+
+def print_affinity_layout(layout):
+    for node, cpus in sorted(layout["nodes"].items()):
+        print("NUMA node {}: cores {}".format(node, format_cpulist(cpus)))
+    print(
+        "Trainer: {} threads on cores {}".format(
+            len(layout["trainer"]), format_cpulist(layout["trainer"])
+        )
+    )
+    print(
+        "DataLoader workers: {} on cores {}".format(
+            layout["num_workers"], format_cpulist(layout["workers"])
+        )
+    )
+    if layout["num_workers"] > len(layout["workers"]):
+        print(
+            "  /!\\ more workers than cores: reduce data.loaders.num_workers "
+            "or data.loaders.affinity.trainer_cores"
+        )
+
+
+def set_trainer_affinity(layout):
+    """Pins the current (main) process to the trainer's cores and sizes its
+    intra-op thread pool accordingly
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, layout["trainer"])
+    torch.set_num_threads(len(layout["trainer"]))
+
+
+def limit_threads():
+    """Limits torch, OpenCV and BLAS / OpenMP (through threadpoolctl) thread
+    pools of the current process to a single thread. OpenCV and threadpoolctl
+    are optional
+    """
+    torch.set_num_threads(1)
+    try:
+        import cv2
+
+        cv2.setNumThreads(1)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+def init_worker(cpus, worker_id):
+    """DataLoader worker_init_fn pinning the worker to cpus with a single thread
+
+    Args:
+        cpus (list): cores the workers may use
+        worker_id (int): id of the worker, in its loader
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    limit_threads()
@@ -0,0 +1,191 @@
+"""Chooses the training DataLoaders' options (num_workers, prefetch_factor,
+pin_memory...) by briefly measuring the throughput of the training batches, as
+the Trainer iterates them, for candidate values.
+
+Options are tuned one at a time, in the order of
+opts.data.loaders.autotune.candidates, each one keeping the cheapest value
+(first in its list) within tolerance of the best throughput. The chosen values
+are written to output_path/opts.yaml with autotune.done set, so that runs
+using or resuming from that file reuse them without measuring again.
+"""
+from copy import deepcopy
+from pathlib import Path
+from time import sleep, time
+
+import torch
+import yaml
+
+from omnigan.affinity import available_cpus
+from omnigan.data import get_dataset, get_loader, get_multi_domain_loader
+
+
+def train_datasets(opts):
+    """Creates the training datasets once for all candidates
+
+    Returns:
+        dict: {domain: Dataset}
+    """
+    return {
+        domain: get_dataset("train", domain, opts)
+        for domain in opts.domains
+        if domain in opts.data.files.get("train", {})
+    }
+
+
+def train_batches(datasets, opts):
+    """Infinite iterator over training batches, as iterated by the Trainer: from
+    a single multi-domain loader if opts.data.loaders.unified, or zipping the
+    domains' loaders otherwise
+
+    Args:
+        datasets (dict): {domain: Dataset}
+        opts (addict.Dict): options
+
+    Returns:
+        iterator: yields tuples of per-domain batches
+    """
+    if opts.data.loaders.get("unified", False):
+        return iter(get_multi_domain_loader(datasets, opts, infinite=True))
+    return zip(
+        *[
+            iter(get_loader("train", domain, opts, infinite=True, dataset=dataset))
+            for domain, dataset in datasets.items()
+        ]
+    )
+
+
+def measure(batches, n_batches, warmup=0, step_time=0.0):
+    """Measures the throughput of an iterator over tuples of batches and the
+    time the main process waits for them (including the transfer to the GPU, if
+    any). The main process spends step_time on each batch, like a training step
+
+    Args:
+        batches (iterator): yields tuples of batches
+        n_batches (int): number of measured batches
+        warmup (int, optional): batches skipped before measuring, while workers
+            start. Defaults to 0.
+        step_time (float, optional): seconds spent on each batch. Defaults to 0.0.
+
+    Returns:
+        tuple: (samples per second, average wait per batch in seconds)
+    """
+    cuda = torch.cuda.is_available()
+    for _ in range(warmup):
+        next(batches)
+    samples = 0
+    wait = 0.0
+    start = time()
+    for _ in range(n_batches):
+        t = time()
+        multi_batch = next(batches)
+        for batch in multi_batch:
+            for tensor in batch["data"].values():
+                if cuda:
+                    tensor.to("cuda", non_blocking=True)
+            samples += len(batch["domain"])
+        if cuda:
+            torch.cuda.synchronize()
+        wait += time() - t
+        if step_time:
+            sleep(step_time)
+    return samples / (time() - start), wait / n_batches
+
+
+def skip_candidate(key, loaders_opts, n_loaders, n_measured):
+    """Whether a candidate setting is pointless on this machine: more workers
+    than cpus, pinning memory without a GPU or other prefetch factors without
+    workers
+    """
+    if loaders_opts.get("num_workers", 8) * n_loaders > len(available_cpus()):
+        return True
+    if key == "prefetch_factor" and loaders_opts.get("num_workers", 8) == 0:
+        return n_measured > 0
+    return bool(loaders_opts.get("pin_memory")) and not torch.cuda.is_available()
+
+
+def autotune_loaders(opts):
+    """Chooses the options in opts.data.loaders.autotune.candidates by measuring
+    the training batches' throughput, unless opts.data.loaders.autotune.done.
+    opts is updated in place and saved to output_path/opts.yaml if it exists
+
+    Args:
+        opts (addict.Dict): options
+
+    Returns:
+        dict: {option: chosen value}
+    """
+    conf = opts.data.loaders.autotune
+    candidates = conf.get("candidates") or {}
+    if conf.get("done"):
+        chosen = {k: opts.data.loaders.get(k) for k in candidates}
+        print("Using autotuned loaders options", chosen)
+        return chosen
+
+    datasets = train_datasets(opts)
+    n_batches = conf.get("batches", 20)
+    tolerance = conf.get("tolerance", 0.05)
+    print(
+        "Autotuning loaders options on {} batches per candidate".format(n_batches)
+    )
+
+    chosen = {}
+    for key, values in candidates.items():
+        results = []
+        for value in values:
+            trial = deepcopy(opts)
+            trial.data.loaders[key] = value
+            n_loaders = 1 if trial.data.loaders.get("unified") else len(datasets)
+            if skip_candidate(key, trial.data.loaders, n_loaders, len(results)):
+                continue
+            batches = train_batches(datasets, trial)
+            samples_per_s, wait = measure(
+                batches, n_batches, conf.get("warmup", 3), conf.get("step_time", 0.0)
+            )
+            # shut down the candidate's workers
+            del batches
+            print(
+                "  {}={}: {:.1f} samples/s, {:.1f} ms wait per batch".format(
+                    key, value, samples_per_s, wait * 1000
+                )
+            )
+            results.append((value, samples_per_s))
+        if not results:
+            continue
+        best = max(samples_per_s for _, samples_per_s in results)
+        chosen[key] = next(v for v, s in results if s >= (1 - tolerance) * best)
+        opts.data.loaders[key] = chosen[key]
+
+    conf.done = True
+    print("Autotuned loaders options:", chosen)
+
+    opts_path = Path(opts.output_path or ".") / "opts.yaml"
+    if opts.output_path and opts_path.parent.exists():
+        with opts_path.open("w") as f:
+            yaml.safe_dump(opts.to_dict(), f)
+        print("  Saved to", opts_path)
+    return chosen
+
+
+def reuse_autotuned(opts):
+    """Copies the autotuned loaders options of an existing
+    output_path/opts.yaml into opts, when resuming a run
+
+    Args:
+        opts (addict.Dict): options
+
+    Returns:
+        bool: whether autotuned options were found
+    """
+    opts_path = Path(opts.output_path or ".") / "opts.yaml"
+    if not opts.output_path or not opts_path.exists():
+        return False
+    with opts_path.open("r") as f:
+        saved = (yaml.safe_load(f) or {}).get("data", {}).get("loaders", {})
+    autotune = saved.get("autotune") or {}
+    if not autotune.get("done"):
+        return False
+    for key in autotune.get("candidates") or {}:
+        if key in saved:
+            opts.data.loaders[key] = saved[key]
+    opts.data.loaders.autotune.done = True
+    return True
@@ -0,0 +1,126 @@
+"""On-disk cache of decoded tensors: the deterministic part of the data pipeline
+(decoding + leading Resize transforms) is computed once and stored as uint8 or
+float16 .npy files which are memory-mapped on later reads.
+
+Files are written atomically so DataLoader workers and concurrent runs on the
+same machine can share a cache directory.
+"""
+import hashlib
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+class TensorCache:
+    def __init__(self, root, transforms=None, max_size=50, as_float=True):
+        """Cache tensors loaded by a loader function and transformed by the
+        deterministic transforms
+
+        Args:
+            root (str or pathlib.Path): cache directory
+            transforms (list, optional): deterministic transforms applied to the
+                loaded tensors before they are cached. Defaults to None.
+            max_size (int, optional): size of the cache in GB above which least
+                recently used files are evicted. Defaults to 50.
+            as_float (bool, optional): return float32 tensors instead of the
+                cached uint8 and float16 ones. Defaults to True.
+        """
+        self.root = Path(root).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.transforms = transforms or []
+        self.signature = " -> ".join(repr(t) for t in self.transforms)
+        self.max_size = int(max_size * 2 ** 30)
+        self.as_float = as_float
+        # check the cache's size every time that many bytes have been written
+        self.evict_every = max(self.max_size // 100, 1)
+        self.written = 0
+
+    def key(self, path, task, domain):
+        mtime = os.stat(path).st_mtime_ns
+        key = "|".join(map(str, [path, mtime, task, domain, self.signature]))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def file(self, key):
+        return self.root / key[:2] / (key + ".npy")
+
+    def load(self, path, task, domain, loader):
+        """Returns the transformed tensor for (path, task, domain) from the cache
+        or computes it with loader(path, task, domain) and the transforms
+
+        Args:
+            path (str): path to the data
+            task (str): task of the data
+            domain (str): domain of the data
+            loader (callable): loading function, like data.tensor_loader
+
+        Returns:
+            torch.Tensor: float32 tensor, or uint8 (float16 for depth) if
+                not self.as_float
+        """
+        cache_file = self.file(self.key(path, task, domain))
+        try:
+            arr = np.load(cache_file, mmap_mode="r")
+            # update mtime for the least-recently-used eviction
+            os.utime(cache_file)
+            tensor = torch.from_numpy(np.array(arr))
+        except (FileNotFoundError, ValueError):
+            tensor = loader(path, task, domain)
+            for t in self.transforms:
+                tensor = t({task: tensor})[task]
+            tensor = self.store(cache_file, task, tensor)
+
+        if self.as_float:
+            return tensor.to(torch.float32)
+        return tensor
+
+    def store(self, cache_file, task, tensor):
+        if task == "d":
+            arr = tensor.numpy().astype(np.float16)
+        else:
+            arr = tensor.float().round().clamp(0, 255).numpy().astype(np.uint8)
+
+        cache_file.parent.mkdir(exist_ok=True)
+        tmp_file = cache_file.parent / "{}.{}.tmp".format(cache_file.stem, uuid.uuid4())
+        with open(tmp_file, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_file, cache_file)
+
+        self.written += arr.nbytes
+        if self.written >= self.evict_every:
+            self.written = 0
+            self.evict()
+
+        return torch.from_numpy(arr)
+
+    def evict(self):
+        """Deletes least recently used files until the cache is under 90% of
+        its max_size
+        """
+        files = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".npy"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(f[1] for f in files)
+        if size <= self.max_size:
+            return
+
+        for _, file_size, path in sorted(files):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already evicted by another worker
+                pass
+            size -= file_size
+            if size <= 0.9 * self.max_size:
+                break
@@ -30,7 +30,9 @@ class OmniClassifier(nn.Module):
                 BasicBlock(proj_dim, int(proj_dim / 2), True),
                 nn.MaxPool2d(2),
                 BasicBlock(int(proj_dim / 2), int(proj_dim / 4), True),
-                nn.AvgPool2d((int(self.feature_size / 4), int(self.feature_size / 4))),
+                # same as AvgPool2d(feature_size / 4) for square latents, and
+                # works for any latent size (see data.buckets)
+                nn.AdaptiveAvgPool2d(1),
                 Squeeze(-1),
                 Squeeze(-1),
                 nn.Linear(int(proj_dim / 4), 2),
@@ -2,19 +2,33 @@
 Transforms for loaders are in transforms.py
 """
 
-from pathlib import Path
-import yaml
+import hashlib
+import io
 import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from time import perf_counter
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
 from torchvision import transforms as trsfs
 from imageio import imread
 from torchvision import transforms
 import numpy as np
-from .transforms import get_transforms
+from .transforms import get_decode_size, get_transforms, interpolation
+from .transforms import nearest_indices
+from .transforms import scale_transforms, split_deterministic
 from .transforms import ToTensor
 from PIL import Image
 from omnigan.tutils import get_normalized_depth_t
+from omnigan.affinity import get_affinity_layout, init_worker
+from omnigan.shards import ShardReader
+from omnigan.cache import TensorCache
+from omnigan.manifest import load_manifest
 
 # ? paired dataset
 
@@ -98,29 +112,173 @@ def pil_image_loader(path, task):
     return Image.fromarray(arr)
 
 
-def tensor_loader(path, task, domain):
+def roi_read(path, source, task, size=None):
+    """Reads an image or array, decoding only what is needed for the size
+    (h, w) it will then be resized to: JPEGs are decoded with the smallest DCT
+    scale keeping them larger than size and .npy files of tasks resized with
+    nearest interpolation are memory-mapped and subsampled to size
+
+    Without size, this is np.load or imread.
+
+    Args:
+        path (str): path to the data, used for its extension
+        source (str or file-like): path or content of the file
+        task (str): task of the data
+        size (tuple, optional): target size. Defaults to None.
+
+    Returns:
+        np.array: H x W (x C) array
+    """
+    suffix = Path(path).suffix
+    if suffix == ".npy":
+        if size is not None and isinstance(source, (str, Path)):
+            arr = np.load(source, mmap_mode="r")
+        else:
+            arr = np.load(source)
+    elif suffix in {".jpg", ".JPG", ".jpeg", ".JPEG"} and size is not None:
+        im = Image.open(source)
+        # draft() keeps the decoded image at least as large as requested
+        im.draft(im.mode, (size[1], size[0]))
+        return np.asarray(im)
+    else:
+        arr = imread(source)
+
+    if size is not None and interpolation(task) == "nearest":
+        rows = nearest_indices(arr.shape[0], size[0])
+        cols = nearest_indices(arr.shape[1], size[1])
+        arr = arr[rows][:, cols]
+    return np.asarray(arr)
+
+
+def pack_mask(arr):
+    """Bit-packs a mask: a pixel is 1 if it is not 0 in arr's first channel
+
+    Args:
+        arr (np.array): H x W (x C) mask
+
+    Returns:
+        dict: {"bits": H x ceil(W / 8) uint8 array, "shape": [H, W]}
+    """
+    if arr.ndim == 3:
+        arr = arr[:, :, 0]
+    return {"bits": np.packbits(arr != 0, axis=1), "shape": np.array(arr.shape)}
+
+
+def write_packed_mask(path):
+    """Writes a mask image as a bit-packed .npz next to it, see pack_mask
+
+    Args:
+        path (str): path to the mask
+
+    Returns:
+        pathlib.Path: path to the packed mask
+    """
+    packed = Path(path).with_suffix(".npz")
+    tmp = packed.parent / "{}.{}.tmp".format(packed.name, os.getpid())
+    with open(tmp, "wb") as f:
+        np.savez(f, **pack_mask(imread(path)))
+    os.replace(tmp, packed)
+    return packed
+
+
+def read_packed_mask(source, size=None, window=None):
+    """Reads a mask written by write_packed_mask, only unpacking the bytes
+    needed for window and size
+
+    Args:
+        source (str or file-like): path or content of the .npz file
+        size (tuple, optional): (h, w) to subsample the mask to. Defaults to None.
+        window (tuple, optional): (top, left, height, width) region to read.
+            Defaults to None.
+
+    Returns:
+        np.array: H x W uint8 array of 0s and 1s
+    """
+    with np.load(source) as packed:
+        bits = packed["bits"]
+        h, w = packed["shape"]
+    top, left, height, width = window or (0, 0, h, w)
+    rows = np.arange(top, top + height)
+    if size is not None:
+        rows = rows[nearest_indices(height, size[0])]
+    first = left // 8
+    arr = np.unpackbits(bits[rows, first : (left + width + 7) // 8], axis=1)
+    arr = arr[:, left - 8 * first : left - 8 * first + width]
+    if size is not None:
+        arr = arr[:, nearest_indices(width, size[1])]
+    return np.ascontiguousarray(arr)
+
+
+def depth_store_path(path):
+    """Path of the float16 normalized depth written by write_depth_store next to
+    a Unity depth map, used by tensor_loader instead of decoding the map
+    """
+    return Path(path).with_suffix(".depth.npy")
+
+
+def write_depth_store(path):
+    """Decodes and normalizes a Unity depth map as tensor_loader does and saves
+    it as an H x W float16 array in depth_store_path(path)
+
+    Args:
+        path (str): path to the Unity depth map
+
+    Returns:
+        pathlib.Path: path to the stored array
+    """
+    arr = torch.from_numpy(imread(path))
+    depth = get_normalized_depth_t(arr, "s", normalize=True).squeeze(0)
+    store = depth_store_path(path)
+    tmp = store.parent / "{}.{}.tmp".format(store.name, os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, depth.numpy().astype(np.float16))
+    os.replace(tmp, store)
+    return store
+
+
+def tensor_loader(
+    path, task, domain, data=None, uint8=False, size=None, depth_store=False
+):
     """load data as tensors
 
     Args:
         path (str): path to data
         task (str):
-        domain 
+        domain
+        data (bytes, optional): the file's content if it has already been read,
+            as from a shard. path is then only used for its extension.
+            Defaults to None.
+        uint8 (bool, optional): return uint8 tensors (float16 for depth) instead
+            of float32 ones, see data.loaders.transport. Defaults to False.
+        size (tuple, optional): (h, w) the data will be resized to, allowing
+            reduced-size decoding, see roi_read. Defaults to None.
+        depth_store (bool, optional): read the depth of the s domain from
+            depth_store_path(path), written by convert_data.py. Defaults to False.
     Returns:
         [Tensor]: C x H x W
     """
+    source = path if data is None else io.BytesIO(data)
+    dtype = np.uint8 if uint8 else np.float32
+    if task == "m" and Path(path).suffix == ".npz":
+        # bit-packed by convert_data.py
+        arr = torch.from_numpy(read_packed_mask(source, size))[None, None]
+        return arr if uint8 else arr.to(torch.float32)
+    if task == "d" and domain == "s" and data is None and depth_store:
+        # decoded and normalized by convert_data.py
+        store = str(depth_store_path(path))
+        arr = torch.from_numpy(np.array(roi_read(store, store, task, size)))
+        arr = arr[None, None]
+        return arr if uint8 else arr.to(torch.float32)
     if task == "d":
-        if Path(path).suffix == ".npy":
-            arr = np.load(path)
-        else:
-            arr = imread(path)  # .astype(np.uint8)
+        arr = roi_read(path, source, task, size)
         arr = torch.from_numpy(arr)
         arr = get_normalized_depth_t(arr, domain, normalize=True)
         arr = arr.unsqueeze(0)
+        if uint8:
+            arr = arr.to(torch.float16)
         return arr
-    elif Path(path).suffix == ".npy":
-        arr = np.load(path).astype(np.float32)  # .astype(np.uint8)
-    elif is_image_file(path):
-        arr = imread(path).astype(np.float32)  # .astype(np.uint8)
+    elif Path(path).suffix == ".npy" or is_image_file(path):
+        arr = roi_read(path, source, task, size).astype(dtype)
     else:
         raise ValueError("Unknown data type {}".format(path))
 
@@ -140,8 +298,78 @@ def tensor_loader(path, task, domain):
     return torch.from_numpy(arr).unsqueeze(0)
 
 
+def get_repeats(mode, opts):
+    """Number of augmented views of each decoded training sample,
+    opts.data.loaders.repeated_augmentations. Always 1 in val mode
+
+    Args:
+        mode (str): train or val
+        opts (addict.Dict): options
+
+    Returns:
+        int: the number of repeats
+    """
+    if mode != "train":
+        return 1
+    repeats = opts.data.loaders.get("repeated_augmentations") or 1
+    if repeats < 1:
+        raise ValueError("repeated_augmentations should be >= 1, not %s" % repeats)
+    return repeats
+
+
+class StageTimer:
+    def __init__(self, stages=()):
+        """Accumulates the time spent in the named stages of loading an item,
+        see data.loaders.timings
+
+        Args:
+            stages (iterable, optional): stages initialized to 0 so that all
+                the items of a dataset have the same keys. Defaults to ().
+        """
+        self.timings = dict.fromkeys(stages, 0.0)
+
+    @contextmanager
+    def __call__(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = (
+                self.timings.get(stage, 0.0) + perf_counter() - start
+            )
+
+    def transform(self, transform, data):
+        """Applies transform, timing each transform of a Compose separately
+        (transforms of the same type are summed)
+        """
+        for t in getattr(transform, "transforms", [transform]):
+            with self("transform_" + type(t).__name__):
+                data = t(data)
+        return data
+
+    def item_timings(self):
+        """
+        Returns:
+            dict: {stage: seconds} and the id of the worker which loaded the
+                item as "worker" (-1 in the main process)
+        """
+        info = get_worker_info()
+        self.timings["worker"] = info.id if info is not None else -1
+        return self.timings
+
+
+def get_stages(tasks, transform):
+    """Stages timed by StageTimer for an OmniListDataset's items: read_{task}
+    (reading the file, for images), decode_{task} and transform_{name}
+    """
+    stages = ["{}_{}".format(s, t) for t in sorted(tasks) for s in ["read", "decode"]]
+    for t in getattr(transform, "transforms", [transform] if transform else []):
+        stages.append("transform_" + type(t).__name__)
+    return stages
+
+
 class OmniListDataset(Dataset):
-    def __init__(self, mode, domain, opts, transform=None):
+    def __init__(self, mode, domain, opts, transform=None, cache=None):
 
         self.domain = domain
         self.mode = mode
@@ -156,28 +384,75 @@ class OmniListDataset(Dataset):
                 opts.data.files[mode][domain]
             )
 
-        if file_list_path.suffix == ".json":
-            self.samples_paths = self.json_load(file_list_path)
-        elif file_list_path.suffix in {".yaml", ".yml"}:
-            self.samples_paths = self.yaml_load(file_list_path)
-        else:
-            raise ValueError("Unknown file list type in {}".format(file_list_path))
-
-        self.filter_samples()
-        self.check_samples()
+        # only keep data required for the model's tasks, as a compact manifest
+        self.samples_paths = load_manifest(
+            file_list_path, self.tasks, opts.data.get("manifest", {}).get("cache")
+        )
         self.file_list_path = str(file_list_path)
+        self.check_opts = opts.data.check_samples
+        self.check_samples()
         self.transform = transform
+        self.cache = cache
+        # decode data directly at the size of the first Resize
+        self.roi_decoding = opts.data.loaders.roi_decoding and cache is None
+        self.uint8 = opts.data.loaders.get("transport", "float32") == "uint8"
+        self.decode_size = None
+        if self.roi_decoding and transform:
+            self.decode_size = get_decode_size(transform.transforms)
+        # depth stores written by convert_data.py are only used if every
+        # sample has one, so that they're looked up once, not per sample
+        self.depth_store = (
+            domain == "s"
+            and "d" in self.samples_paths.tasks
+            and all(
+                depth_store_path(p).exists() for p in self.samples_paths.column("d")
+            )
+        )
+        self.loader = partial(
+            tensor_loader,
+            uint8=self.uint8,
+            size=self.decode_size,
+            depth_store=self.depth_store,
+        )
+        # aspect ratio buckets, see set_buckets
+        self.bucket_of = None
+        self.bucket_transforms = None
+        self.bucket_loaders = None
+        # repeated augmentation: the last decoded sample is augmented again
+        # when the sampler repeats its index
+        self.repeats = get_repeats(mode, opts)
+        self.decoded = None
+        # per-stage timings in item["timings"]
+        self.timings = opts.data.loaders.get("timings", False)
 
-    def filter_samples(self):
-        """
-        Filter out data which is not required for the model's tasks
-        as defined in opts.tasks
+    def set_buckets(self, sizes, bucket_of):
+        """Sets the aspect ratio bucket of each sample: samples are then
+        transformed to their bucket's size with transforms scaled from
+        self.transform's ones
+
+        Args:
+            sizes (list): (h, w) of each bucket
+            bucket_of (np.array): bucket index of each sample
         """
-        self.samples_paths = [
-            {k: v for k, v in s.items() if k in self.tasks} for s in self.samples_paths
+        self.bucket_of = bucket_of
+        self.bucket_transforms = [
+            transforms.Compose(scale_transforms(self.transform.transforms, size))
+            for size in sizes
+        ]
+        self.bucket_loaders = [
+            partial(
+                tensor_loader,
+                uint8=self.uint8,
+                size=get_decode_size(t.transforms) if self.roi_decoding else None,
+                depth_store=self.depth_store,
+            )
+            for t in self.bucket_transforms
         ]
 
     def __getitem__(self, i):
+        return self.get_item(i)
+
+    def get_item(self, i, bucketed=True):
         """Return an item in the dataset with fields:
         {
             data: transform({
@@ -189,72 +464,966 @@ class OmniListDataset(Dataset):
         }
         Args:
             i (int): index of item to retrieve
+            bucketed (bool, optional): transform the item to the size of its
+                aspect ratio bucket, if set_buckets was called. Defaults to True.
         Returns:
             dict: dataset item where tensors of data are in item["data"] which is a dict
                   {task: tensor}
         """
         paths = self.samples_paths[i]
+        transform, loader = self.transform, self.loader
+        if bucketed and self.bucket_of is not None:
+            bucket = self.bucket_of[i]
+            transform = self.bucket_transforms[bucket]
+            loader = self.bucket_loaders[bucket]
 
         # always apply transforms,
         # if no transform is specified, ToTensor and Normalize will be applied
 
+        timer = None
+        if self.timings:
+            timer = StageTimer(get_stages(self.tasks, transform))
+
+        if self.decoded is not None and self.decoded[:2] == (i, loader):
+            data = self.decoded[2]
+        elif timer is not None:
+            data = {
+                task: self.timed_load(loader, path, task, timer)
+                for task, path in paths.items()
+            }
+        elif self.cache is not None:
+            # decoded and deterministically transformed
+            data = {
+                task: self.cache.load(path, task, self.domain, loader)
+                for task, path in paths.items()
+            }
+        else:
+            data = {task: loader(path, task, self.domain) for task, path in paths.items()}
+        if self.repeats > 1:
+            self.decoded = (i, loader, data)
+
         item = {
-            "data": self.transform(
-                {
-                    task: tensor_loader(path, task, self.domain)
-                    for task, path in paths.items()
-                }
-            ),
+            "data": transform(data)
+            if timer is None
+            else timer.transform(transform, data),
             "paths": paths,
             "domain": self.domain,
             "mode": self.mode,
         }
+        if timer is not None:
+            item["timings"] = timer.item_timings()
         # if "d" in item["data"]:
         #    item["data"]["d"] = get_normalized_depth_t(item["data"]["d"], self.domain)
 
         return item
 
+    def timed_load(self, loader, path, task, timer):
+        """Loads a file like loader(path, task, self.domain), timing the file
+        read and decoding separately when possible
+
+        Returns:
+            torch.Tensor: the loaded data
+        """
+        if self.cache is not None:
+            with timer("decode_" + task):
+                return self.cache.load(path, task, self.domain, loader)
+        if is_image_file(path) and not (task == "d" and self.depth_store):
+            with timer("read_" + task):
+                with open(path, "rb") as f:
+                    data = f.read()
+            with timer("decode_" + task):
+                return loader(path, task, self.domain, data=data)
+        with timer("decode_" + task):
+            return loader(path, task, self.domain)
+
     def __len__(self):
         return len(self.samples_paths)
 
-    def json_load(self, file_path):
-        with open(file_path, "r") as f:
-            return json.load(f)
+    def sample_dirs(self):
+        """Groups the listed files by directory
 
-    def yaml_load(self, file_path):
-        with open(file_path, "r") as f:
-            return yaml.safe_load(f)
+        Returns:
+            dict: {directory: [(task, file name)]}
+        """
+        dirs = {}
+        for k in self.samples_paths.tasks:
+            for v in self.samples_paths.column(k):
+                dirname, name = os.path.split(v)
+                dirs.setdefault(dirname, []).append((k, name))
+        return dirs
+
+    def fingerprint_path(self, dirs):
+        """File marking a successful check_samples of the current file list,
+        tasks and directories' mtimes (files were added or removed if they
+        changed)
+
+        Args:
+            dirs (dict): the sample_dirs()
+
+        Returns:
+            pathlib.Path: the fingerprint, None if opts.data.check_samples.cache
+                is not set
+        """
+        cache = self.check_opts.get("cache")
+        if not cache:
+            return None
+        with ThreadPoolExecutor(self.check_opts.get("num_threads", 16)) as executor:
+            mtimes = list(executor.map(dir_mtime, sorted(dirs)))
+        fingerprint = hashlib.sha1()
+        with open(self.file_list_path, "rb") as f:
+            fingerprint.update(f.read())
+        fingerprint.update(" ".join(sorted(self.tasks)).encode())
+        for d, mtime in zip(sorted(dirs), mtimes):
+            fingerprint.update("{}:{}".format(d, mtime).encode())
+        return Path(cache).expanduser() / fingerprint.hexdigest()
 
     def check_samples(self):
         """Checks that every file listed in samples_paths actually
-        exist on the file-system
+        exist on the file-system.
+
+        Directories are listed once each, in parallel, instead of checking
+        each file. If the list file and the directories' mtimes did not change
+        since the last successful check (stored as a fingerprint in
+        opts.data.check_samples.cache), the check is skipped.
+        """
+        dirs = self.sample_dirs()
+        num_threads = self.check_opts.get("num_threads", 16)
+        fingerprint_path = self.fingerprint_path(dirs)
+        if fingerprint_path is not None and fingerprint_path.exists():
+            return
+
+        with ThreadPoolExecutor(num_threads) as executor:
+            listings = dict(zip(dirs, executor.map(list_dir, dirs)))
+
+        for dirname, names in dirs.items():
+            for k, name in names:
+                v = os.path.join(dirname, name)
+                assert name in listings[dirname], f"{k} {v} does not exist"
+
+        if fingerprint_path is not None:
+            fingerprint_path.parent.mkdir(parents=True, exist_ok=True)
+            fingerprint_path.touch()
+
+
+def dir_mtime(dirname):
+    try:
+        return os.stat(dirname or ".").st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def list_dir(dirname):
+    try:
+        return {entry.name for entry in os.scandir(dirname or ".")}
+    except FileNotFoundError:
+        return set()
+
+
+class OmniShardDataset(Dataset):
+    def __init__(self, mode, domain, opts, transform=None):
+        """Same items as OmniListDataset but read from the packed shards
+        compiled by compile_dataset.py in opts.data.shards.path/{mode}_{domain}
+        """
+        self.domain = domain
+        self.mode = mode
+        self.tasks = set(opts.tasks)
+        self.tasks.add("x")
+        if "p" in self.tasks:
+            self.tasks.add("m")
+
+        self.reader = ShardReader(
+            Path(opts.data.shards.path) / "{}_{}".format(mode, domain)
+        )
+        self.file_list_path = self.reader.index_path
+        self.transform = transform
+        self.decode_size = None
+        if opts.data.loaders.roi_decoding and transform:
+            self.decode_size = get_decode_size(transform.transforms)
+        self.loader = partial(
+            tensor_loader,
+            uint8=opts.data.loaders.get("transport", "float32") == "uint8",
+            size=self.decode_size,
+        )
+        self.repeats = get_repeats(mode, opts)
+        self.decoded = None
+        self.timings = opts.data.loaders.get("timings", False)
+
+    def __getitem__(self, i):
+        """Return an item in the dataset, see OmniListDataset.__getitem__
+
+        Args:
+            i (int): index of item to retrieve
+        Returns:
+            dict: dataset item where tensors of data are in item["data"] which is a dict
+                  {task: tensor}
         """
-        for s in self.samples_paths:
-            for k, v in s.items():
-                assert Path(v).exists(), f"{k} {v} does not exist"
+        timer = None
+        if self.timings:
+            stages = ["read"] + get_stages(self.tasks, self.transform)
+            timer = StageTimer(s for s in stages if not s.startswith("read_"))
+
+        if self.decoded is not None and self.decoded[0] == i:
+            _, paths, data = self.decoded
+        else:
+            if timer is None:
+                sample = self.reader.read(i, self.tasks)
+            else:
+                with timer("read"):
+                    sample = self.reader.read(i, self.tasks)
+            paths = {task: path for task, (path, _) in sample.items()}
+            data = {}
+            for task, (path, task_data) in sample.items():
+                if timer is None:
+                    data[task] = self.loader(path, task, self.domain, data=task_data)
+                else:
+                    with timer("decode_" + task):
+                        data[task] = self.loader(
+                            path, task, self.domain, data=task_data
+                        )
+        if self.repeats > 1:
+            self.decoded = (i, paths, data)
+
+        item = {
+            "data": self.transform(data)
+            if timer is None
+            else timer.transform(self.transform, data),
+            "paths": paths,
+            "domain": self.domain,
+            "mode": self.mode,
+        }
+        if timer is not None:
+            item["timings"] = timer.item_timings()
+
+        return item
+
+    def __len__(self):
+        return len(self.reader)
+
+
+def repeated_permutation(size, repeats=1):
+    """Random permutation of range(size) where, for repeated augmentation, only
+    the first ceil(size / repeats) indices are kept and each is repeated
+    consecutively repeats times, so that its length is still size
+
+    Args:
+        size (int): number of indices
+        repeats (int, optional): consecutive repeats of each index. Defaults to 1.
+
+    Returns:
+        list: the indices
+    """
+    perm = torch.randperm(size)
+    if repeats > 1:
+        perm = perm[: int(np.ceil(size / repeats))].repeat_interleave(repeats)
+    return perm[:size].tolist()
+
 
+class InfiniteSampler(Sampler):
+    def __init__(self, size, shuffle=True, repeats=1):
+        """Yields a dataset's indices forever, reshuffling them at each pass so that
+        a DataLoader's iterator, and therefore its workers, are never re-created
 
-def get_loader(mode, domain, opts):
+        Args:
+            size (int): length of the dataset
+            shuffle (bool, optional): shuffle indices. Defaults to True.
+            repeats (int, optional): repeated augmentations, see
+                RepeatedAugmentationSampler. Defaults to 1.
+        """
+        self.size = size
+        self.shuffle = shuffle
+        self.repeats = repeats
+
+    def __iter__(self):
+        while True:
+            if self.shuffle:
+                yield from repeated_permutation(self.size, self.repeats)
+            else:
+                yield from range(self.size)
+
+
+class RepeatedAugmentationSampler(Sampler):
+    def __init__(self, size, repeats):
+        """Shuffles a dataset's indices and repeats each index consecutively, so
+        that a decoded sample is augmented repeats times (the dataset keeps its
+        last decoded sample). An epoch is still size samples long: it sees
+        size / repeats different samples, a different subset at each epoch
+
+        Args:
+            size (int): length of the dataset
+            repeats (int): augmentations of each decoded sample
+        """
+        self.size = size
+        self.repeats = repeats
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        yield from repeated_permutation(self.size, self.repeats)
+
+
+def image_aspect_ratio(path):
+    """w / h of an image, only reading its header, or of a .npy array"""
+    if Path(path).suffix == ".npy":
+        h, w = np.load(path, mmap_mode="r").shape[:2]
+        return w / h
+    with Image.open(path) as im:
+        w, h = im.size
+    return w / h
+
+
+def get_aspect_ratios(dataset, cache=None, num_threads=16):
+    """Aspect ratios (w / h) of the images (x) of an OmniListDataset, cached in
+    cache, keyed by the file list's path and mtime, if it is not None
+
+    Args:
+        dataset (OmniListDataset): the dataset
+        cache (str, optional): cache directory. Defaults to None.
+        num_threads (int, optional): images read in parallel. Defaults to 16.
+
+    Returns:
+        np.array: float32 aspect ratio of each sample
+    """
+    cache_file = None
+    if cache:
+        key = "{}|{}".format(
+            dataset.file_list_path, os.stat(dataset.file_list_path).st_mtime_ns
+        )
+        cache_file = Path(cache).expanduser() / (
+            hashlib.sha1(key.encode()).hexdigest() + ".npy"
+        )
+        if cache_file.exists():
+            return np.load(cache_file)
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        ratios = np.array(
+            list(executor.map(image_aspect_ratio, dataset.samples_paths.column("x"))),
+            dtype=np.float32,
+        )
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.parent / "{}.{}.tmp".format(cache_file.name, os.getpid())
+        with open(tmp, "wb") as f:
+            np.save(f, ratios)
+        os.replace(tmp, cache_file)
+    return ratios
+
+
+def get_bucket_sizes(pixels, multiple, max_ratio=2.5):
+    """Resolution buckets: (h, w) sizes with h and w multiples of multiple,
+    h * w about pixels and an aspect ratio between 1 / max_ratio and max_ratio
+
+    Args:
+        pixels (int): pixel budget of a bucket
+        multiple (int): h and w are multiples of it
+        max_ratio (float, optional): largest aspect ratio. Defaults to 2.5.
+
+    Raises:
+        ValueError: if there are fewer than 2 such sizes, as all samples would
+            then be resized to the same size
+
+    Returns:
+        list: (h, w) sizes, sorted by aspect ratio
+    """
+    sizes = set()
+    h = multiple
+    while h <= np.sqrt(pixels * max_ratio):
+        w = max(multiple, int(round(pixels / h / multiple)) * multiple)
+        if 1 / max_ratio <= w / h <= max_ratio:
+            sizes.add((h, w))
+            sizes.add((w, h))
+        h += multiple
+    if len(sizes) < 2:
+        raise ValueError(
+            "{} {}-pixel bucket(s) with dims multiple of {}: increase pixels or "
+            "max_ratio or decrease multiple".format(len(sizes), pixels, multiple)
+        )
+    return sorted(sizes, key=lambda size: size[1] / size[0])
+
+
+def assign_buckets(ratios, sizes):
+    """Index of the bucket with the closest aspect ratio for each sample
+
+    Args:
+        ratios (np.array): aspect ratios (w / h) of the samples
+        sizes (list): (h, w) of the buckets
+
+    Returns:
+        np.array: bucket index of each sample
+    """
+    bucket_ratios = np.array([w / h for h, w in sizes])
+    distances = np.abs(np.log(ratios)[:, None] - np.log(bucket_ratios)[None, :])
+    return distances.argmin(axis=1)
+
+
+class AspectRatioBucketSampler(Sampler):
+    def __init__(self, bucket_of, batch_size, infinite=False, repeats=1):
+        """Batch sampler yielding batches of samples from a single aspect ratio
+        bucket. Samples are shuffled within their bucket and batches are
+        shuffled across buckets at every epoch
+
+        Args:
+            bucket_of (np.array): bucket index of each sample
+            batch_size (int): batch size
+            infinite (bool, optional): yield batches forever. Defaults to False.
+            repeats (int, optional): repeated augmentations, see
+                RepeatedAugmentationSampler. Defaults to 1.
+        """
+        self.buckets = [
+            np.flatnonzero(bucket_of == b) for b in range(bucket_of.max() + 1)
+        ]
+        self.batch_size = batch_size
+        self.infinite = infinite
+        self.repeats = repeats
+
+    def __len__(self):
+        return sum(
+            int(np.ceil(len(indices) / self.batch_size)) for indices in self.buckets
+        )
+
+    def epoch(self):
+        batches = []
+        for indices in self.buckets:
+            indices = indices[repeated_permutation(len(indices), self.repeats)]
+            indices = indices.tolist()
+            batches += [
+                indices[k : k + self.batch_size]
+                for k in range(0, len(indices), self.batch_size)
+            ]
+        return [batches[k] for k in torch.randperm(len(batches)).tolist()]
+
+    def __iter__(self):
+        yield from self.epoch()
+        while self.infinite:
+            yield from self.epoch()
+
+
+def get_bucket_sampler(dataset, opts, infinite=False):
+    """Assigns the samples of an OmniListDataset to aspect ratio buckets with
+    a budget of opts.data.buckets.pixels pixels and dims multiple of
+    opts.data.buckets.multiple (by default 2 ** opts.gen.p.spade_n_up, for the
+    painter) and returns the sampler of batches from single buckets
+
+    Args:
+        dataset (OmniListDataset): the dataset
+        opts (addict.Dict): options
+        infinite (bool, optional): yield batches forever. Defaults to False.
+
+    Returns:
+        AspectRatioBucketSampler: the batch sampler
+    """
+    conf = opts.data.buckets
+    if not isinstance(dataset, OmniListDataset) or dataset.cache is not None:
+        raise ValueError("data.buckets can't be used with data.shards or data.cache")
+    if opts.data.get("augmentation", "workers") == "batch":
+        raise ValueError("data.buckets can't be used with data.augmentation: batch")
+    if opts.data.loaders.get("unified", False):
+        raise ValueError("data.buckets can't be used with data.loaders.unified")
+
+    sizes = get_bucket_sizes(
+        conf.get("pixels", 512 * 512),
+        conf.multiple or 2 ** opts.gen.p.spade_n_up,
+        conf.get("max_ratio", 2.5),
+    )
+    ratios = get_aspect_ratios(
+        dataset, conf.get("cache"), opts.data.check_samples.get("num_threads", 16)
+    )
+    bucket_of = assign_buckets(ratios, sizes)
+    dataset.set_buckets(sizes, bucket_of)
+    counts = np.bincount(bucket_of, minlength=len(sizes))
+    print(
+        "Aspect ratio buckets of {}: {}".format(
+            dataset.file_list_path,
+            ", ".join("{}x{}: {}".format(h, w, n) for (h, w), n in zip(sizes, counts)),
+        )
+    )
+    return AspectRatioBucketSampler(
+        bucket_of,
+        opts.data.loaders.get("batch_size", 4),
+        infinite=infinite,
+        repeats=dataset.repeats,
+    )
+
+
+def get_dataset(mode, domain, opts):
+    """Creates the Dataset for a (mode, domain) pair: an OmniShardDataset if
+    opts.data.shards.use, an OmniListDataset otherwise
+
+    Args:
+        mode (str): train or val
+        domain (str): r, s or rf
+        opts (addict.Dict): options
+
+    Validation samples are transformed deterministically (no flips, center
+    crops) if opts.data.val.deterministic
+
+    Returns:
+        torch.utils.data.Dataset: the dataset
+    """
+    transform_list = get_transforms(
+        opts, deterministic=mode == "val" and opts.data.val.get("deterministic", False)
+    )
+
+    if opts.data.shards.use:
+        return OmniShardDataset(
+            mode, domain, opts, transform=transforms.Compose(transform_list)
+        )
+
+    cache = None
+    if opts.data.cache.use:
+        cached_transforms, transform_list = split_deterministic(transform_list)
+        cache = TensorCache(
+            opts.data.cache.path or "~/.cache/omnigan/tensors",
+            cached_transforms,
+            opts.data.cache.get("max_size", 50),
+            as_float=opts.data.loaders.get("transport", "float32") != "uint8",
+        )
+    return OmniListDataset(
+        mode, domain, opts, transform=transforms.Compose(transform_list), cache=cache,
+    )
+
+
+def get_loader_kwargs(opts, num_workers=None, layout=None):
+    """DataLoader keyword arguments from opts.data.loaders
+
+    Args:
+        opts (addict.Dict): options
+        num_workers (int, optional): overrides opts.data.loaders.num_workers.
+            Defaults to None.
+        layout (dict, optional): affinity layout of the run, computed before the
+            trainer was pinned to its cores. Defaults to None (computed from the
+            cores the current process may use).
+
+    Returns:
+        dict: num_workers, pin_memory and, with workers, prefetch_factor,
+            persistent_workers and, if opts.data.loaders.affinity.use, a
+            worker_init_fn pinning workers to their cores (see affinity.py)
+    """
+    if num_workers is None:
+        num_workers = opts.data.loaders.get("num_workers", 8)
+    kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": bool(opts.data.loaders.get("pin_memory", False))
+        and torch.cuda.is_available(),
+    }
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = opts.data.loaders.get("prefetch_factor", 2)
+        kwargs["persistent_workers"] = opts.data.loaders.get(
+            "persistent_workers", False
+        )
+        if opts.data.loaders.affinity.use:
+            layout = layout or get_affinity_layout(opts)
+            kwargs["worker_init_fn"] = partial(init_worker, layout["workers"])
+    return kwargs
+
+
+def get_loader(
+    mode, domain, opts, infinite=False, num_workers=None, dataset=None, layout=None
+):
+    """Creates the DataLoader for a (mode, domain) pair
+
+    Args:
+        mode (str): train or val
+        domain (str): r, s or rf
+        opts (addict.Dict): options
+        infinite (bool, optional): sample the dataset forever with an
+            InfiniteSampler, to be iterated with a single persistent iterator.
+            Defaults to False.
+        num_workers (int, optional): overrides opts.data.loaders.num_workers.
+            Defaults to None.
+        dataset (torch.utils.data.Dataset, optional): use this dataset instead
+            of creating it with get_dataset. Defaults to None.
+        layout (dict, optional): affinity layout, see get_loader_kwargs.
+            Defaults to None.
+
+    If opts.data.buckets.use, training batches are sampled by an
+    AspectRatioBucketSampler. If opts.data.loaders.repeated_augmentations is
+    K > 1, each training sample is decoded once and augmented K times: its index
+    is repeated K times in a row by the sampler, so the K views usually land in
+    the same batch (use a batch size multiple of K)
+
+    Returns:
+        torch.utils.data.DataLoader: the loader
+    """
     if "simclr" in opts.tasks:
         return "SIMCLR LOADER"
 
+    if dataset is None:
+        dataset = get_dataset(mode, domain, opts)
+    kwargs = get_loader_kwargs(opts, num_workers, layout)
+
+    if mode == "train" and opts.data.buckets.use:
+        kwargs["batch_sampler"] = get_bucket_sampler(dataset, opts, infinite)
+        return DataLoader(dataset, **kwargs)
+
+    if infinite:
+        kwargs["sampler"] = InfiniteSampler(len(dataset), repeats=dataset.repeats)
+    elif dataset.repeats > 1:
+        kwargs["sampler"] = RepeatedAugmentationSampler(len(dataset), dataset.repeats)
+    else:
+        # kwargs["shuffle"] = opts.data.loaders.get("shuffle", True)
+        kwargs["shuffle"] = True
+
+    return DataLoader(
+        dataset, batch_size=opts.data.loaders.get("batch_size", 4), **kwargs
+    )
+
+
+class MultiDomainDataset(Dataset):
+    def __init__(self, datasets):
+        """Wraps one dataset per domain, indexed with (domain, index) tuples
+
+        Args:
+            datasets (dict): {domain: Dataset}
+        """
+        self.datasets = datasets
+
+    def __getitem__(self, index):
+        domain, i = index
+        return self.datasets[domain][i]
+
+    def __len__(self):
+        return sum(len(d) for d in self.datasets.values())
+
+
+class MultiDomainBatchSampler(Sampler):
+    def __init__(self, sizes, batch_sizes, infinite=False, repeats=1):
+        """Yields batches of (domain, index) made of batch_sizes[domain] samples
+        of each domain, shuffled independently in each domain.
+
+        Like zipping per-domain loaders, an epoch stops when the shortest domain
+        is exhausted. If infinite, each domain is reshuffled when exhausted and
+        batches are yielded forever.
+
+        Args:
+            sizes (dict): {domain: length of the domain's dataset}
+            batch_sizes (dict): {domain: batch size}
+            infinite (bool, optional): never stop. Defaults to False.
+            repeats (int, optional): repeated augmentations, see
+                RepeatedAugmentationSampler. Defaults to 1.
+        """
+        self.sizes = sizes
+        self.batch_sizes = batch_sizes
+        self.infinite = infinite
+        self.repeats = repeats
+
+    def __len__(self):
+        return min(
+            int(np.ceil(self.sizes[d] / self.batch_sizes[d])) for d in self.sizes
+        )
+
+    def __iter__(self):
+        if self.infinite:
+            streams = {
+                d: iter(InfiniteSampler(n, repeats=self.repeats))
+                for d, n in self.sizes.items()
+            }
+            while True:
+                yield [
+                    (d, next(streams[d]))
+                    for d in self.sizes
+                    for _ in range(self.batch_sizes[d])
+                ]
+
+        perms = {
+            d: repeated_permutation(n, self.repeats) for d, n in self.sizes.items()
+        }
+        for k in range(len(self)):
+            yield [
+                (d, i)
+                for d, bs in self.batch_sizes.items()
+                for i in perms[d][k * bs : (k + 1) * bs]
+            ]
+
+
+def multi_domain_collate(items):
+    """Collates items from several domains into a tuple of per-domain batches,
+    in the order in which domains appear in items
+
+    Args:
+        items (list): dataset items, with an item["domain"] key
+
+    Returns:
+        tuple: one batch per domain, as a DataLoader over that domain would yield
+    """
+    domains = {}
+    for item in items:
+        domains.setdefault(item["domain"], []).append(item)
+    return tuple(default_collate(domain_items) for domain_items in domains.values())
+
+
+def get_multi_domain_loader(datasets, opts, infinite=False, layout=None):
+    """Creates a single DataLoader, with a single worker pool, yielding the
+    tuple of per-domain batches for all datasets at once.
+
+    Per-domain batch sizes are read from opts.data.loaders.batch_sizes[domain],
+    defaulting to opts.data.loaders.batch_size
+
+    Args:
+        datasets (dict): {domain: Dataset}
+        opts (addict.Dict): options
+        infinite (bool, optional): yield batches forever. Defaults to False.
+        layout (dict, optional): affinity layout, see get_loader_kwargs.
+            Defaults to None.
+
+    Returns:
+        torch.utils.data.DataLoader: the loader
+    """
+    batch_size = opts.data.loaders.get("batch_size", 4)
+    batch_sizes = opts.data.loaders.get("batch_sizes") or {}
+    sampler = MultiDomainBatchSampler(
+        {domain: len(dataset) for domain, dataset in datasets.items()},
+        {domain: batch_sizes.get(domain, batch_size) for domain in datasets},
+        infinite=infinite,
+        repeats=max(dataset.repeats for dataset in datasets.values()),
+    )
     return DataLoader(
-        OmniListDataset(
-            mode, domain, opts, transform=transforms.Compose(get_transforms(opts))
-        ),
+        MultiDomainDataset(datasets),
+        batch_sampler=sampler,
+        collate_fn=multi_domain_collate,
+        **get_loader_kwargs(opts, layout=layout)
+    )
+
+
+class ResidentDataset(Dataset):
+    def __init__(self, data, paths, domain, mode, root=None):
+        """Dataset of already decoded and transformed samples, stacked per task
+        in memory or in memory-mapped .npy files. Use materialize_dataset to
+        create one.
+
+        Args:
+            data (dict): {task: N x ... tensor or np.memmap}
+            paths (list): {task: path} of each sample
+            domain (str): r, s or rf
+            mode (str): train or val
+            root (pathlib.Path, optional): directory of the memory-mapped
+                files. Defaults to None.
+        """
+        self.data = data
+        self.paths = paths
+        self.domain = domain
+        self.mode = mode
+        self.root = root
+
+    @classmethod
+    def load(cls, root):
+        """Memory-maps a dataset written by materialize_dataset"""
+        root = Path(root)
+        with open(root / "paths.json", "r") as f:
+            meta = json.load(f)
+        data = {
+            task: np.load(root / "{}.npy".format(task), mmap_mode="r")
+            for task in meta["tasks"]
+        }
+        return cls(data, meta["paths"], meta["domain"], meta["mode"], root)
+
+    def __getstate__(self):
+        # workers started with spawn memory-map the files again
+        state = self.__dict__.copy()
+        if self.root is not None:
+            state["data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.data is None:
+            self.data = ResidentDataset.load(self.root).data
+
+    def __len__(self):
+        return len(self.paths)
+
+    def tensor(self, task, index):
+        tensor = self.data[task][index]
+        if isinstance(tensor, np.ndarray):
+            # copy memory-mapped data
+            tensor = torch.from_numpy(np.array(tensor))
+        return tensor
+
+    def __getitem__(self, i):
+        """Same items as OmniListDataset's"""
+        return {
+            "data": {task: self.tensor(task, i) for task in self.data},
+            "paths": self.paths[i],
+            "domain": self.domain,
+            "mode": self.mode,
+        }
+
+    def batch(self, start, end):
+        """Items start to end, batched as a DataLoader would"""
+        paths = self.paths[start:end]
+        return {
+            "data": {task: self.tensor(task, slice(start, end)) for task in self.data},
+            "paths": {task: [p[task] for p in paths] for task in paths[0]},
+            "domain": [self.domain] * len(paths),
+            "mode": [self.mode] * len(paths),
+        }
+
+
+class ResidentLoader:
+    def __init__(self, dataset, batch_size):
+        """Iterates over a ResidentDataset's batches, in order, without workers
+
+        Args:
+            dataset (ResidentDataset): the dataset
+            batch_size (int): batch size
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.dataset) / self.batch_size))
+
+    def __iter__(self):
+        for start in range(0, len(self.dataset), self.batch_size):
+            yield self.dataset.batch(start, start + self.batch_size)
+
+
+def materialize_dataset(dataset, opts, root=None, layout=None):
+    """Loads all the items of a dataset once, in memory or in memory-mapped .npy
+    files in root. All items must have the same size (deterministic transforms
+    ending with a resize or crop).
+
+    If root is a directory, the dataset is stored there once, keyed by its
+    file list's path and mtime, its tasks, its transforms and its decoding
+    options, and memory-mapped from there on later calls
+
+    Args:
+        dataset (torch.utils.data.Dataset): the dataset to materialize
+        opts (addict.Dict): options, for the loader used to read the dataset
+        root (str, optional): cache directory. Defaults to None (in memory).
+        layout (dict, optional): affinity layout, see get_loader_kwargs.
+            Defaults to None.
+
+    Returns:
+        ResidentDataset: the materialized dataset
+    """
+    if root is not None:
+        key = "|".join(
+            map(
+                str,
+                [
+                    Path(dataset.file_list_path).resolve(),
+                    os.stat(dataset.file_list_path).st_mtime_ns,
+                    sorted(dataset.tasks),
+                    dataset.transform.transforms,
+                    opts.data.loaders.get("transport", "float32"),
+                    # decoding options
+                    dataset.decode_size,
+                    getattr(dataset, "depth_store", False),
+                ],
+            )
+        )
+        root = Path(root).expanduser() / hashlib.sha1(key.encode()).hexdigest()
+        if root.exists():
+            return ResidentDataset.load(root)
+        tmp = root.parent / "{}.{}.tmp".format(root.name, os.getpid())
+        tmp.mkdir(parents=True)
+
+    n = len(dataset)
+    loader = DataLoader(
+        dataset,
         batch_size=opts.data.loaders.get("batch_size", 4),
-        # shuffle=opts.data.loaders.get("shuffle", True),
-        shuffle=True,
-        num_workers=opts.data.loaders.get("num_workers", 8),
+        **get_loader_kwargs(opts, layout=layout)
+    )
+    data = {}
+    paths = []
+    for batch in loader:
+        start = len(paths)
+        end = start + len(batch["domain"])
+        for task, tensor in batch["data"].items():
+            if task not in data:
+                shape = (n,) + tuple(tensor.shape[1:])
+                dtype = tensor.numpy().dtype
+                if root is None:
+                    data[task] = np.empty(shape, dtype)
+                else:
+                    data[task] = np.lib.format.open_memmap(
+                        tmp / "{}.npy".format(task), "w+", dtype, shape
+                    )
+            data[task][start:end] = tensor.numpy()
+        paths += [
+            {task: batch["paths"][task][k] for task in batch["paths"]}
+            for k in range(end - start)
+        ]
+
+    if root is None:
+        data = {task: torch.from_numpy(arr) for task, arr in data.items()}
+        return ResidentDataset(data, paths, dataset.domain, dataset.mode)
+
+    for arr in data.values():
+        arr.flush()
+    with open(tmp / "paths.json", "w") as f:
+        json.dump(
+            {
+                "tasks": list(data),
+                "paths": paths,
+                "domain": dataset.domain,
+                "mode": dataset.mode,
+            },
+            f,
+        )
+    try:
+        os.rename(tmp, root)
+    except OSError:
+        # another process wrote it first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return ResidentDataset.load(root)
+
+
+def get_resident_loader(mode, domain, opts, layout=None):
+    """Creates a ResidentLoader over the materialized (mode, domain) dataset,
+    stored in opts.data.val.path if it is set, in memory otherwise. layout is
+    the affinity layout of the materializing loader, see get_loader_kwargs
+
+    Returns:
+        ResidentLoader: the loader
+    """
+    print("Materializing {} {} samples...".format(mode, domain), end="", flush=True)
+    dataset = materialize_dataset(
+        get_dataset(mode, domain, opts), opts, opts.data.val.get("path"), layout
     )
+    print(" {} samples".format(len(dataset)))
+    return ResidentLoader(dataset, opts.data.loaders.get("batch_size", 4))
+
+
+def get_all_loaders(opts, layout=None):
+    """Creates loaders[mode][domain] for all domains in opts.domains.
+    If opts.train.steps_per_epoch is set, training loaders are infinite.
 
+    If opts.data.loaders.unified, batches are produced by get_multi_domain_loader
+    and those loaders don't use workers: they only give access to the datasets
 
-def get_all_loaders(opts):
+    If opts.data.val.resident, validation loaders are ResidentLoaders
+
+    Args:
+        opts (addict.Dict): options
+        layout (dict, optional): affinity layout computed before the trainer
+            was pinned to its cores, see get_loader_kwargs. Defaults to None.
+
+    Returns:
+        dict: {mode: {domain: DataLoader}}
+    """
+    unified = opts.data.loaders.get("unified", False)
     loaders = {}
     for mode in ["train", "val"]:
         loaders[mode] = {}
         for domain in opts.domains:
             if mode in opts.data.files:
                 if domain in opts.data.files[mode]:
-                    loaders[mode][domain] = get_loader(mode, domain, opts)
+                    if mode == "val" and opts.data.val.get("resident", False):
+                        loaders[mode][domain] = get_resident_loader(
+                            mode, domain, opts, layout
+                        )
+                        continue
+                    loaders[mode][domain] = get_loader(
+                        mode,
+                        domain,
+                        opts,
+                        infinite=mode == "train"
+                        and bool(opts.train.steps_per_epoch)
+                        and not unified,
+                        num_workers=0 if unified else None,
+                        layout=layout,
+                    )
     return loaders
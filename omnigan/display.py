@@ -0,0 +1,154 @@
+"""Images logged by the Trainer (see opts.comet.display_size): for each
+(mode, domain), the display items are collated into a single batch.
+
+Display sets are built in the main thread when first used, saved to
+output_path/display_images.pt and loaded from there by resumed runs whose
+datasets are the same. They are sent to the device once.
+"""
+from copy import copy
+from functools import partial
+
+import os
+from pathlib import Path
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+def get_display_indices(opts):
+    if type(opts.comet.display_size) == int:
+        return list(range(opts.comet.display_size))
+    return list(opts.comet.display_size)
+
+
+class DisplaySets:
+    def __init__(self, loaders, indices, to_device, path=None, key=None):
+        """Display sets of all loaders, built (or loaded) by the first get()
+
+        Args:
+            loaders (dict): {mode: {domain: loader}} whose datasets are used
+            indices (list): indices of the display items in each dataset
+            to_device (callable): sends a batch to the trainer's device
+            path (pathlib.Path, optional): file to save the sets to, or to load
+                them from if it exists. Defaults to None.
+            key (object, optional): how items are loaded (e.g. data.loaders.
+                transport): saved sets are only loaded if their key, indices
+                and datasets (see sources) are the same. Defaults to None.
+        """
+        self.indices = indices
+        self.key = key
+        self.to_device = to_device
+        self.path = path
+        self.device_sets = {}
+        self.datasets = {
+            mode: {domain: loader.dataset for domain, loader in domain_dict.items()}
+            for mode, domain_dict in loaders.items()
+        }
+        self.sets = None
+
+    def sources(self):
+        """What the display items are read from: each dataset's file list, with
+        its modification time, and transforms
+
+        Returns:
+            dict: {mode: {domain: (file list, mtime, transforms)}}
+        """
+        sources = {}
+        for mode, domain_dict in self.datasets.items():
+            sources[mode] = {}
+            for domain, dataset in domain_dict.items():
+                file_list = getattr(dataset, "file_list_path", None)
+                transform = getattr(dataset, "transform", None)
+                sources[mode][domain] = (
+                    file_list and str(Path(file_list).resolve()),
+                    file_list and os.stat(file_list).st_mtime_ns,
+                    transform and repr(transform.transforms),
+                )
+        return sources
+
+    def build(self):
+        """Loads the display sets from self.path if they match, collates them
+        from the datasets (and saves them) otherwise.
+
+        This runs in the main thread (see get): decoding samples in a thread
+        while DataLoader workers are forked can deadlock them on the import
+        lock (e.g. imageio's lazy plugin imports)
+
+        Returns:
+            dict: {mode: {domain: batch}}
+        """
+        sources = self.sources()
+        if self.path is not None and self.path.exists():
+            saved = torch.load(self.path)
+            if (saved["indices"], saved["key"], saved.get("sources")) == (
+                self.indices,
+                self.key,
+                sources,
+            ):
+                return saved["sets"]
+        sets = {}
+        for mode, domain_dict in self.datasets.items():
+            sets[mode] = {}
+            for domain, dataset in domain_dict.items():
+                batch = self.collate(dataset)
+                if batch is not None:
+                    sets[mode][domain] = batch
+        if self.path is not None and self.path.parent.exists():
+            torch.save(
+                {
+                    "indices": self.indices,
+                    "key": self.key,
+                    "sources": sources,
+                    "sets": sets,
+                },
+                self.path,
+            )
+        return sets
+
+    def collate(self, dataset):
+        """Loads the display items of a dataset as a single batch
+
+        Returns:
+            dict: the batch, None if the dataset has no display item
+        """
+        # don't leave the display items as the dataset's last decoded sample
+        dataset = copy(dataset)
+        if hasattr(dataset, "decoded"):
+            dataset.decoded = None
+        get_item = dataset.__getitem__
+        if getattr(dataset, "bucket_of", None) is not None:
+            # display images must all have the same size
+            get_item = partial(dataset.get_item, bucketed=False)
+        items = [get_item(i) for i in self.indices if i < len(dataset)]
+        if not items:
+            return None
+        for item in items:
+            item.pop("timings", None)
+        return default_collate(items)
+
+    def get(self, mode, domain):
+        """Device-resident display batch of (mode, domain)
+
+        Returns:
+            dict: the batch, None if there is no display item
+        """
+        if self.sets is None:
+            self.sets = self.build()
+        if (mode, domain) not in self.device_sets:
+            batch = self.sets.get(mode, {}).get(domain)
+            if batch is not None:
+                batch = dict(batch, data=dict(batch["data"]))
+                batch = self.to_device(batch)
+            self.device_sets[(mode, domain)] = batch
+        return self.device_sets[(mode, domain)]
+
+    def items(self, mode, domain):
+        """Yields the display items of (mode, domain) as {task: 1 x C x H x W}
+        tensors on the device
+        """
+        batch = self.get(mode, domain)
+        if batch is None:
+            return
+        n = len(batch["domain"])
+        for i in range(n):
+            yield {task: tensor[i : i + 1] for task, tensor in batch["data"].items()}
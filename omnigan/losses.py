@@ -1,6 +1,8 @@
 """Define all losses. When possible, as inheriting from nn.Module
 To send predictions to target.device
 """
+from functools import wraps
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -10,6 +12,27 @@ from random import random as rand
 from torchvision import models
 
 
+def float32(call):
+    """Decorates a loss' __call__ so that it is computed in float32, outside of
+    autocast regions (see opts.train.amp): floating point tensor arguments are
+    cast to float32
+    """
+
+    @wraps(call)
+    def wrapper(self, *args, **kwargs):
+        device_type = next(
+            (a.device.type for a in args if isinstance(a, torch.Tensor)), "cpu"
+        )
+        args = [
+            a.float() if isinstance(a, torch.Tensor) and a.is_floating_point() else a
+            for a in args
+        ]
+        with torch.autocast(device_type, enabled=False):
+            return call(self, *args, **kwargs)
+
+    return wrapper
+
+
 class GANLoss(nn.Module):
     def __init__(
         self,
@@ -63,6 +86,7 @@ class GANLoss(nn.Module):
             target_tensor = self.fake_label + soft_change
         return target_tensor.expand_as(input)
 
+    @float32
     def __call__(self, input, target_is_real):
         if rand() < self.flip_prob:
             target_is_real = not target_is_real
@@ -106,6 +130,7 @@ class BinaryCrossEntropy(nn.Module):
         super().__init__()
         self.loss = torch.nn.BCELoss()
 
+    @float32
     def __call__(self, logits, target):
         return self.loss(logits, target.to(logits.device))
 
@@ -244,6 +269,7 @@ class SIMSELoss(nn.Module):
     def __init__(self):
         super(SIMSELoss, self).__init__()
 
+    @float32
     def __call__(self, prediction, target):
         d = prediction - target
         diff = torch.mean(d * d)
@@ -358,7 +384,7 @@ def get_losses(opts, verbose, device=None):
         losses["G"]["tasks"]["s"] = CrossEntropy()
     if "m" in opts.tasks:
         losses["G"]["tasks"]["m"] = {}
-        losses["G"]["tasks"]["m"]["main"] = nn.BCELoss()
+        losses["G"]["tasks"]["m"]["main"] = BinaryCrossEntropy()
         losses["G"]["tasks"]["m"]["tv"] = TVLoss(opts.train.lambdas.G.m.tv)
         losses["G"]["tasks"]["m"]["advent"] = ADVENTAdversarialLoss(opts)
 
@@ -403,12 +429,11 @@ class CustomBCELoss(nn.Module):
         super().__init__()
         self.loss = torch.nn.BCEWithLogitsLoss()
 
+    @float32
     def __call__(self, prediction, target):
         return self.loss(
             prediction,
-            torch.FloatTensor(prediction.size())
-            .fill_(target)
-            .to(prediction.get_device()),
+            torch.FloatTensor(prediction.size()).fill_(target).to(prediction.device),
         )
 
 
@@ -0,0 +1,251 @@
+"""Compact sample manifests: the {task: path} samples of a file list are stored
+as one utf-8 byte array and one offsets array per task instead of a list of
+dicts of strings. DataLoader workers then don't duplicate the manifest by
+touching the reference counts of millions of Python objects (copy-on-write),
+and paths are only rebuilt when a sample is accessed.
+
+Converted manifests are cached as .npy files which are memory-mapped, so the
+json / yaml file list is only parsed when it changes.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+
+def read_file_list(file_list_path):
+    """Reads a json, json lines (one sample per line) or yaml file list
+
+    Args:
+        file_list_path (str or pathlib.Path): path to the file list
+
+    Returns:
+        iterable: samples as {task: path} dicts, a generator for json lines
+    """
+    file_list_path = Path(file_list_path)
+    if file_list_path.suffix == ".jsonl":
+        return read_json_lines(file_list_path)
+    with open(file_list_path, "r") as f:
+        if file_list_path.suffix == ".json":
+            return json.load(f)
+        if file_list_path.suffix in {".yaml", ".yml"}:
+            return yaml.safe_load(f)
+    raise ValueError("Unknown file list type in {}".format(file_list_path))
+
+
+def read_json_lines(file_list_path):
+    """Yields the samples of a json lines file list, one at a time
+
+    Args:
+        file_list_path (str or pathlib.Path): path to the .jsonl file
+
+    Yields:
+        dict: sample as {task: path}
+    """
+    with open(file_list_path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_json_lines(samples, file_list_path):
+    """Writes samples to a json lines file list, atomically
+
+    Args:
+        samples (iterable): samples as {task: path} dicts
+        file_list_path (str or pathlib.Path): path to the .jsonl file
+
+    Returns:
+        int: number of samples written
+    """
+    file_list_path = Path(file_list_path)
+    tmp = file_list_path.parent / "{}.{}.tmp".format(file_list_path.name, uuid.uuid4())
+    n = 0
+    with open(tmp, "w") as f:
+        for sample in samples:
+            f.write(json.dumps(sample) + "\n")
+            n += 1
+    os.replace(tmp, file_list_path)
+    return n
+
+
+class SamplesManifest:
+    def __init__(self, columns, root=None):
+        """List of samples {task: path} stored as numpy arrays. Use
+        SamplesManifest.from_samples or load_manifest to create one.
+
+        Args:
+            columns (dict): {task: (paths, offsets)} where paths is a uint8 array
+                of utf-8 encoded paths and sample i's path is
+                paths[offsets[i]:offsets[i + 1]] (empty if it has no such task)
+            root (pathlib.Path, optional): directory the columns are
+                memory-mapped from. Defaults to None.
+        """
+        self.columns = columns
+        self.root = root
+        self.length = len(next(iter(columns.values()))[1]) - 1 if columns else 0
+
+    @classmethod
+    def from_samples(cls, samples, tasks=None):
+        """Creates a manifest from {task: path} samples
+
+        Args:
+            samples (iterable): samples as {task: path} dicts
+            tasks (set, optional): only keep those tasks. Defaults to None (all).
+
+        Returns:
+            SamplesManifest: the manifest
+        """
+        encoded = {}
+        n = 0
+        for n, sample in enumerate(samples, 1):
+            for task, path in sample.items():
+                if tasks is not None and task not in tasks:
+                    continue
+                encoded.setdefault(task, {})[n - 1] = str(path).encode()
+
+        columns = {}
+        for task in sorted(encoded):
+            paths = encoded[task]
+            lengths = np.zeros(n + 1, dtype=np.int64)
+            for i, path in paths.items():
+                lengths[i + 1] = len(path)
+            offsets = np.cumsum(lengths)
+            data = np.frombuffer(
+                b"".join(paths.get(i, b"") for i in range(n)), dtype=np.uint8
+            )
+            columns[task] = (data, offsets)
+        return cls(columns)
+
+    @classmethod
+    def load(cls, root):
+        """Memory-maps a manifest written by SamplesManifest.save
+
+        Args:
+            root (str or pathlib.Path): directory of the manifest
+
+        Returns:
+            SamplesManifest: the manifest
+        """
+        root = Path(root)
+        columns = {}
+        for offsets_file in sorted(root.glob("*_offsets.npy")):
+            task = offsets_file.name[: -len("_offsets.npy")]
+            columns[task] = (
+                np.load(root / "{}_paths.npy".format(task), mmap_mode="r"),
+                np.load(offsets_file, mmap_mode="r"),
+            )
+        return cls(columns, root)
+
+    def save(self, root):
+        """Writes the manifest's columns as .npy files in root
+
+        Args:
+            root (str or pathlib.Path): directory to write to
+        """
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        for task, (data, offsets) in self.columns.items():
+            np.save(root / "{}_paths.npy".format(task), data)
+            np.save(root / "{}_offsets.npy".format(task), offsets)
+
+    def __getstate__(self):
+        # workers started with spawn memory-map the files again instead of
+        # receiving a copy of the arrays
+        state = self.__dict__.copy()
+        if self.root is not None:
+            state["columns"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.columns is None:
+            self.columns = SamplesManifest.load(self.root).columns
+
+    @property
+    def tasks(self):
+        return list(self.columns)
+
+    def column(self, task):
+        """Yields all the paths of a task
+
+        Args:
+            task (str): task to list
+
+        Yields:
+            str: path of each sample which has that task
+        """
+        data, offsets = self.columns[task]
+        data = data.tobytes()
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+            if end > start:
+                yield data[start:end].decode()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("Sample {} out of range".format(i))
+        sample = {}
+        for task, (data, offsets) in self.columns.items():
+            start, end = offsets[i], offsets[i + 1]
+            if end > start:
+                sample[task] = data[start:end].tobytes().decode()
+        return sample
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+
+def load_manifest(file_list_path, tasks=None, cache=None):
+    """Creates the manifest of a file list keeping only tasks.
+
+    If cache is a directory, the manifest is written there once, keyed by the
+    file list's path, mtime and size and by tasks, and memory-mapped from there
+
+    Args:
+        file_list_path (str or pathlib.Path): json, json lines or yaml file list
+        tasks (set, optional): only keep those tasks. Defaults to None (all).
+        cache (str, optional): cache directory. Defaults to None.
+
+    Returns:
+        SamplesManifest: the manifest
+    """
+    file_list_path = Path(file_list_path)
+    if not cache:
+        return SamplesManifest.from_samples(read_file_list(file_list_path), tasks)
+
+    stat = file_list_path.stat()
+    key = "|".join(
+        map(
+            str,
+            [
+                file_list_path.resolve(),
+                stat.st_mtime_ns,
+                stat.st_size,
+                " ".join(sorted(tasks)) if tasks is not None else "*",
+            ],
+        )
+    )
+    root = Path(cache).expanduser() / hashlib.sha1(key.encode()).hexdigest()
+    if not root.exists():
+        manifest = SamplesManifest.from_samples(read_file_list(file_list_path), tasks)
+        # write to a temporary directory and rename it so that concurrent runs
+        # never read a partial manifest
+        tmp = root.parent / "{}.{}.tmp".format(root.name, uuid.uuid4())
+        manifest.save(tmp)
+        try:
+            os.rename(tmp, root)
+        except OSError:
+            # another process wrote it first
+            shutil.rmtree(tmp, ignore_errors=True)
+    return SamplesManifest.load(root)
@@ -93,6 +93,9 @@ class SpectralNorm(nn.Module):
         self.module = module
         self.name = name
         self.power_iterations = power_iterations
+        # see power_iteration_per_step
+        self.per_step = False
+        self.pending = True
         if not self._made_params():
             self._make_params()
 
@@ -102,9 +105,13 @@ class SpectralNorm(nn.Module):
         w = getattr(self.module, self.name + "_bar")
 
         height = w.data.shape[0]
-        for _ in range(self.power_iterations):
-            v.data = l2normalize(torch.mv(torch.t(w.view(height, -1).data), u.data))
-            u.data = l2normalize(torch.mv(w.view(height, -1).data, v.data))
+        if self.pending or not self.per_step:
+            for _ in range(self.power_iterations):
+                v.data = l2normalize(
+                    torch.mv(torch.t(w.view(height, -1).data), u.data)
+                )
+                u.data = l2normalize(torch.mv(w.view(height, -1).data, v.data))
+            self.pending = False
 
         # sigma = torch.dot(u.data, torch.mv(w.view(height,-1).data, v.data))
         sigma = u.dot(w.view(height, -1).mv(v))
@@ -142,6 +149,21 @@ class SpectralNorm(nn.Module):
         return self.module.forward(*args)
 
 
+def power_iteration_per_step(model):
+    """Makes the SpectralNorm modules of model run their power iteration on
+    their next forward pass only, instead of on every forward pass. Called once
+    per training step, u and v are then updated once per step however many
+    times the model runs in it (per domain or fused, per micro-batch)
+
+    Args:
+        model (torch.nn.Module): model with SpectralNorm modules
+    """
+    for module in model.modules():
+        if isinstance(module, SpectralNorm):
+            module.per_step = True
+            module.pending = True
+
+
 class SPADE(nn.Module):
     def __init__(self, param_free_norm_type, kernel_size, norm_nc, cond_nc):
         super().__init__()
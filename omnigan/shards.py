@@ -0,0 +1,217 @@
+"""Packed dataset shards: a compiled dataset is a directory holding a few large
+binary shard files and an index. Each sample's files (x, m, d, s...) are stored
+contiguously so that reading a sample is a single sequential read from a
+memory-mapped shard instead of one file open per task.
+
+The index is stored as .npy arrays (and the paths as a SamplesManifest) which
+are memory-mapped, so that DataLoader workers don't duplicate it by touching the
+reference counts of per-sample Python objects. index.json only holds its header.
+
+Shards are written by compile_dataset.py and read by omnigan.data.OmniShardDataset
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+from omnigan.manifest import SamplesManifest
+
+INDEX_NAME = "index.json"
+INDEX_DIR = "index"
+
+
+def shard_name(k):
+    return "shard_{:05d}.bin".format(k)
+
+
+class ShardWriter:
+    def __init__(self, root, shard_size=1024):
+        """Packs samples into shards of about shard_size MB in root
+
+        Args:
+            root (str or pathlib.Path): directory to write the shards and index to
+            shard_size (int, optional): Maximum size of a shard in MB, a shard
+                can exceed it if a single sample is larger. Defaults to 1024.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.shard_size = int(shard_size * 2 ** 20)
+        self.samples = []
+        self.shard = -1
+        self.offset = 0
+        self.file = None
+        self.open_next_shard()
+
+    def open_next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.shard += 1
+        self.offset = 0
+        self.file = open(self.root / shard_name(self.shard), "wb")
+
+    def add(self, paths):
+        """Appends the files of a sample to the current shard
+
+        Args:
+            paths (dict): sample as {task: path}
+        """
+        blobs = {}
+        for task, path in paths.items():
+            with open(path, "rb") as f:
+                blobs[task] = f.read()
+        length = sum(len(b) for b in blobs.values())
+        if self.offset > 0 and self.offset + length > self.shard_size:
+            self.open_next_shard()
+
+        tasks = {}
+        start = 0
+        for task, blob in blobs.items():
+            self.file.write(blob)
+            tasks[task] = [start, len(blob)]
+            start += len(blob)
+
+        self.samples.append(
+            {
+                "shard": self.shard,
+                "offset": self.offset,
+                "length": length,
+                "tasks": tasks,
+                "paths": {task: str(path) for task, path in paths.items()},
+            }
+        )
+        self.offset += length
+
+    def close(self):
+        """Closes the last shard and writes the index: arrays of each sample's
+        shard, offset and length, and per task of the start and length of its
+        file in the sample (-1 if the sample has no such task)
+        """
+        self.file.close()
+        index = self.root / INDEX_DIR
+        index.mkdir(exist_ok=True)
+        tasks = sorted({task for sample in self.samples for task in sample["tasks"]})
+        for key, dtype in [("shard", np.int32), ("offset", np.int64)]:
+            values = [sample[key] for sample in self.samples]
+            np.save(index / "{}.npy".format(key), np.array(values, dtype=dtype))
+        np.save(
+            index / "length.npy",
+            np.array([sample["length"] for sample in self.samples], dtype=np.int64),
+        )
+        for task in tasks:
+            # (start, length) of the task's file in each sample
+            spans = np.array(
+                [sample["tasks"].get(task, [-1, -1]) for sample in self.samples],
+                dtype=np.int64,
+            ).reshape(-1, 2)
+            np.save(index / "task_{}.npy".format(task), spans)
+        SamplesManifest.from_samples(s["paths"] for s in self.samples).save(
+            index / "paths"
+        )
+        header = {
+            "shards": self.shard + 1,
+            "samples": len(self.samples),
+            "tasks": tasks,
+        }
+        with open(self.root / INDEX_NAME, "w") as f:
+            json.dump(header, f)
+
+
+class ShardReader:
+    def __init__(self, root):
+        """Reads samples written by a ShardWriter. Shards are memory-mapped
+        lazily so that each DataLoader worker opens its own maps
+
+        Args:
+            root (str or pathlib.Path): directory containing the shards and index
+        """
+        self.root = Path(root)
+        index_path = self.root / INDEX_NAME
+        if not index_path.exists():
+            raise ValueError(
+                "No shard index in {}, run compile_dataset.py first".format(self.root)
+            )
+        with open(index_path, "r") as f:
+            header = json.load(f)
+        if not isinstance(header["samples"], int):
+            raise ValueError(
+                "Outdated shard index in {}, run compile_dataset.py again".format(
+                    self.root
+                )
+            )
+        self.length = header["samples"]
+        self.task_names = header["tasks"]
+        self.index_path = str(index_path)
+        self.maps = {}
+        self.load_index()
+
+    def load_index(self):
+        index = self.root / INDEX_DIR
+        self.index = {
+            key: np.load(index / "{}.npy".format(key), mmap_mode="r")
+            for key in ["shard", "offset", "length"]
+        }
+        self.spans = {
+            task: np.load(index / "task_{}.npy".format(task), mmap_mode="r")
+            for task in self.task_names
+        }
+        self.paths = SamplesManifest.load(index / "paths")
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        # don't send memory maps to DataLoader workers: they map them again
+        state = self.__dict__.copy()
+        state["maps"] = {}
+        for key in ["index", "spans", "paths"]:
+            state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load_index()
+
+    def get_map(self, k):
+        if k not in self.maps:
+            self.maps[k] = np.memmap(self.root / shard_name(k), dtype=np.uint8, mode="r")
+        return self.maps[k]
+
+    def read(self, i, tasks=None):
+        """Reads sample i's files with a single read from its shard
+
+        Args:
+            i (int): index of the sample
+            tasks (set, optional): only return those tasks. Defaults to None (all).
+
+        Returns:
+            dict: {task: (original path, file content as bytes)}
+        """
+        offset = int(self.index["offset"][i])
+        length = int(self.index["length"][i])
+        blob = self.get_map(int(self.index["shard"][i]))[offset : offset + length]
+        blob = blob.tobytes()
+        paths = self.paths[i]
+        sample = {}
+        for task, spans in self.spans.items():
+            start, length = (int(v) for v in spans[i])
+            if start >= 0 and (tasks is None or task in tasks):
+                sample[task] = (paths[task], blob[start : start + length])
+        return sample
+
+
+def compile_shards(samples_paths, root, shard_size=1024):
+    """Packs a list of samples {task: path} into shards in root
+
+    Args:
+        samples_paths (list): samples as {task: path} dicts
+        root (str or pathlib.Path): output directory
+        shard_size (int, optional): Maximum size of a shard in MB. Defaults to 1024.
+
+    Returns:
+        int: number of shards written
+    """
+    writer = ShardWriter(root, shard_size)
+    for paths in samples_paths:
+        writer.add(paths)
+    writer.close()
+    return writer.shard + 1
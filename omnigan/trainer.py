@@ -5,6 +5,8 @@
 """
 import os
 from copy import deepcopy
+from functools import partial, reduce
+from itertools import islice
 from pathlib import Path
 from time import time
 
@@ -13,17 +15,28 @@ import torchvision.utils as vutils
 from addict import Dict
 from comet_ml import Experiment
 
+from omnigan.affinity import (
+    get_affinity_layout,
+    print_affinity_layout,
+    set_trainer_affinity,
+)
+from omnigan.autotune import autotune_loaders
 from omnigan.classifier import OmniClassifier, get_classifier
-from omnigan.data import get_all_loaders
+from omnigan.data import get_all_loaders, get_multi_domain_loader
+from omnigan.display import DisplaySets, get_display_indices
 from omnigan.discriminator import OmniDiscriminator, get_dis
 from omnigan.generator import OmniGenerator, get_gen
 from omnigan.losses import get_losses
+from omnigan.norms import power_iteration_per_step
 from omnigan.optim import get_optimizer
+from omnigan.transforms import get_batch_augment
 from omnigan.tutils import (
     domains_to_class_tensor,
     fake_domains_to_class_tensor,
     get_num_params,
     shuffle_batch_tuple,
+    split_batch,
+    uses_batch_statistics,
     vgg_preprocess,
     norm_tensor,
 )
@@ -59,11 +72,28 @@ class Trainer:
         self.logger.lr.d = opts.dis.opt.lr
         self.logger.epoch = 0
         self.loaders = None
+        self.multi_domain_loaders = None
+        self.train_iterator = None
         self.losses = None
 
         self.is_setup = False
 
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        # random transforms applied in batch_to_device if data.augmentation: batch
+        self.batch_augment = get_batch_augment(opts)
+        # loaders send uint8 images, normalized in batch_to_device
+        self.uint8_transport = opts.data.loaders.get("transport", "float32") == "uint8"
+        # mixed precision, see train.amp
+        self.amp_dtype = self.get_amp_dtype()
+        self.scalers = {}
+        # per-step cache of the latent vectors and predictions, see encode
+        self.latents = {}
+        self.fuse_domains = False
+        # gradients are accumulated over micro-batches, see micro_batches
+        self.accumulate_steps = opts.train.get("accumulate_steps") or 1
+        if self.accumulate_steps < 1:
+            raise ValueError("train.accumulate_steps must be at least 1")
+        self.split = None
 
         self.exp = None
         if isinstance(comet_exp, Experiment):
@@ -107,17 +137,38 @@ class Trainer:
             losses, prefix=f"{model_to_update}_{mode}", step=self.logger.global_step
         )
 
-    def batch_to_device(self, b):
-        """sends the data in b to self.device
+    def batch_to_device(self, b, augment=True):
+        """sends the data in b to self.device and applies the batch-level
+        augmentations if opts.data.augmentation is "batch"
+
+        If opts.data.loaders.transport is "uint8", tensors are converted to float32
+        and images are normalized to [-1, 1] once on self.device
 
         Args:
             b (dict): the batch dictionnay
+            augment (bool, optional): apply the batch-level augmentations.
+                Defaults to True.
 
         Returns:
             dict: the batch dictionnary with its "data" field sent to self.device
         """
         for task, tensor in b["data"].items():
-            b["data"][task] = tensor.to(self.device)
+            if self.uint8_transport:
+                tensor = tensor.to(self.device, non_blocking=True).float()
+                if task == "x":
+                    tensor = tensor.div_(127.5).sub_(1.0)
+            else:
+                tensor = tensor.to(self.device)
+            b["data"][task] = tensor
+        if (
+            augment
+            and self.batch_augment is not None
+            and not (
+                b["mode"][0] == "val" and self.opts.data.val.get("deterministic", False)
+            )
+        ):
+            # deterministic validation samples are already transformed
+            b["data"] = self.batch_augment(b["data"])
         return b
 
     def compute_latent_shape(self):
@@ -188,9 +239,40 @@ class Trainer:
         start_time = time()
         self.logger.time.start_time = start_time
 
-        self.loaders = get_all_loaders(self.opts)
+        if self.opts.data.loaders.autotune.use:
+            autotune_loaders(self.opts)
+        # computed once: once pinned, the trainer may only use its own cores
+        self.affinity_layout = None
+        if self.opts.data.loaders.affinity.use:
+            self.affinity_layout = get_affinity_layout(self.opts)
+            print_affinity_layout(self.affinity_layout)
+            set_trainer_affinity(self.affinity_layout)
+        self.loaders = get_all_loaders(self.opts, self.affinity_layout)
+        if self.opts.data.loaders.get("unified", False):
+            # a single worker pool yields batches for all domains
+            self.multi_domain_loaders = {
+                mode: get_multi_domain_loader(
+                    {domain: loader.dataset for domain, loader in domain_dict.items()},
+                    self.opts,
+                    infinite=mode == "train" and bool(self.opts.train.steps_per_epoch),
+                    layout=self.affinity_layout,
+                )
+                for mode, domain_dict in self.loaders.items()
+                if domain_dict
+                and not (mode == "val" and self.opts.data.val.get("resident", False))
+            }
+        self.train_iterator = None
+        self.latents = {}
+        self.split = None
 
         self.G: OmniGenerator = get_gen(self.opts, verbose=self.verbose).to(self.device)
+        self.fuse_domains = self.opts.train.get("fuse_domains", False)
+        if self.fuse_domains and uses_batch_statistics(
+            [self.G.encoder, self.G.decoders]
+        ):
+            # outputs would depend on the other domains' samples
+            print("Ignoring train.fuse_domains: G uses BatchNorm batch statistics")
+            self.fuse_domains = False
         if self.G.encoder is not None:
             self.latent_shape = self.compute_latent_shape()
         self.input_shape = self.compute_input_shape()
@@ -220,6 +302,16 @@ class Trainer:
         else:
             self.c_opt, self.c_scheduler = None, None
 
+        if self.amp_dtype == torch.float16:
+            # bfloat16 has float32's range and needs no loss scaling
+            init_scale = self.opts.train.amp.get("init_scale", 2.0 ** 16)
+            optimizers = {"G": self.g_opt, "D": self.d_opt, "C": self.c_opt}
+            self.scalers = {
+                model: torch.cuda.amp.GradScaler(init_scale=init_scale)
+                for model, opt in optimizers.items()
+                if opt is not None
+            }
+
         if self.opts.train.resume:
             self.resume()
 
@@ -234,69 +326,146 @@ class Trainer:
                         )
                     )
 
-        # Create display images:
-        print("Creating display images...", end="", flush=True)
+        # Display images are built in the main thread when first logged, see display.py
+        self.display_images = DisplaySets(
+            self.loaders,
+            get_display_indices(self.opts),
+            partial(self.batch_to_device, augment=False),
+            Path(self.opts.output_path) / "display_images.pt"
+            if self.opts.output_path
+            else None,
+            key=(
+                self.opts.data.loaders.get("transport", "float32"),
+                sorted(self.opts.tasks),
+            ),
+        )
 
-        if type(self.opts.comet.display_size) == int:
-            display_indices = range(self.opts.comet.display_size)
-        else:
-            display_indices = self.opts.comet.display_size
+        self.is_setup = True
 
-        self.display_images = {}
-        for mode, mode_dict in self.loaders.items():
-            self.display_images[mode] = {}
-            for domain, domain_loader in mode_dict.items():
+    def get_amp_dtype(self):
+        """Autocast dtype of the forward passes and losses from opts.train.amp
 
-                self.display_images[mode][domain] = [
-                    Dict(self.loaders[mode][domain].dataset[i])
-                    for i in display_indices
-                    if i < len(self.loaders[mode][domain].dataset)
-                ]
+        Returns:
+            torch.dtype: torch.bfloat16 or torch.float16, None without mixed precision
+        """
+        amp = self.opts.train.amp
+        if not amp.get("use", False):
+            return None
+        dtype = amp.get("dtype", "bfloat16")
+        if dtype not in {"bfloat16", "float16"}:
+            raise ValueError("Unknown train.amp.dtype {}".format(dtype))
+        if dtype == "float16" and self.device.type != "cuda":
+            raise ValueError("train.amp.dtype float16 needs a GPU, use bfloat16")
+        return getattr(torch, dtype)
+
+    def autocast(self):
+        """Context in which the losses are computed: autocast to self.amp_dtype
+        if using mixed precision, a no-op otherwise
+        """
+        if self.amp_dtype is None:
+            return torch.autocast(self.device.type, enabled=False)
+        return torch.autocast(self.device.type, dtype=self.amp_dtype)
 
-        self.is_setup = True
+    def scale_loss(self, model, loss):
+        """float16 losses are scaled before backward() so that small gradients
+        don't underflow, see opt_step
 
-    def g_opt_step(self):
-        """Run an optimizing step ; if using ExtraAdam, there needs to be an extrapolation
-        step every other step
+        Args:
+            model (str): "G", "D" or "C"
+            loss (torch.Tensor): the model's loss
+
+        Returns:
+            torch.Tensor: the loss to call backward() on
+        """
+        if model in self.scalers:
+            return self.scalers[model].scale(loss)
+        return loss
+
+    def opt_step(self, model):
+        """Run an optimizing step of model ("G", "D" or "C") ; if using ExtraAdam,
+        there needs to be an extrapolation step every other step.
+
+        With float16 loss scaling, gradients are unscaled first and the step is
+        skipped if they are not finite (the loss scale is then reduced)
+
+        Returns:
+            bool: whether the parameters were updated
         """
-        if "extra" in self.opts.gen.opt.optimizer.lower() and (
+        opt, conf = {
+            "G": (self.g_opt, self.opts.gen.opt),
+            "D": (self.d_opt, self.opts.dis.opt),
+            "C": (self.c_opt, self.opts.classifier.opt),
+        }[model]
+        if model in self.scalers:
+            scaler = self.scalers[model]
+            scaler.unscale_(opt)
+            finite = all(
+                torch.isfinite(p.grad).all()
+                for group in opt.param_groups
+                for p in group["params"]
+                if p.grad is not None
+            )
+            scaler.update()
+            if not finite:
+                print(
+                    "Skipping {} step {}: non-finite gradients, loss scale {}".format(
+                        model, self.logger.global_step, scaler.get_scale()
+                    )
+                )
+                return False
+        if "extra" in conf.optimizer.lower() and (
+            # extrapolate again if the previous extrapolation was skipped
             self.logger.global_step % 2 == 0
+            or not opt.params_copy
         ):
-            self.g_opt.extrapolation()
+            opt.extrapolation()
         else:
-            self.g_opt.step()
+            opt.step()
+        return True
+
+    def g_opt_step(self):
+        """Run an optimizing step of G, see opt_step
+        """
+        return self.opt_step("G")
 
     def d_opt_step(self):
-        """Run an optimizing step ; if using ExtraAdam, there needs to be an extrapolation
-        step every other step
+        """Run an optimizing step of D, see opt_step
         """
-        if "extra" in self.opts.dis.opt.optimizer.lower() and (
-            self.logger.global_step % 2 == 0
-        ):
-            self.d_opt.extrapolation()
-        else:
-            self.d_opt.step()
+        return self.opt_step("D")
 
     def c_opt_step(self):
-        """Run an optimizing step ; if using ExtraAdam, there needs to be an extrapolation
-        step every other step
+        """Run an optimizing step of C, see opt_step
         """
-        if "extra" in self.opts.classifier.opt.optimizer.lower() and (
-            self.logger.global_step % 2 == 0
-        ):
-            self.c_opt.extrapolation()
-        else:
-            self.c_opt.step()
+        return self.opt_step("C")
 
     @property
     def train_loaders(self):
         """Get a zip of all training loaders
 
+        If opts.train.steps_per_epoch is set, the loaders are infinite and their
+        iterators are created once and kept across epochs: an epoch is then
+        steps_per_epoch steps.
+
+        If opts.data.loaders.unified, tuples come from a single multi-domain loader
+
         Returns:
             generator: zip generator yielding tuples:
                 (batch_rf, batch_rn, batch_sf, batch_sn)
         """
-        return zip(*list(self.loaders["train"].values()))
+        steps_per_epoch = self.opts.train.steps_per_epoch
+        if not steps_per_epoch:
+            if self.multi_domain_loaders:
+                return self.multi_domain_loaders["train"]
+            return zip(*list(self.loaders["train"].values()))
+
+        if self.train_iterator is None:
+            if self.multi_domain_loaders:
+                self.train_iterator = iter(self.multi_domain_loaders["train"])
+            else:
+                self.train_iterator = zip(
+                    *[iter(l) for l in self.loaders["train"].values()]
+                )
+        return islice(self.train_iterator, steps_per_epoch)
 
     def update_learning_rates(self):
         if self.g_scheduler is not None:
@@ -310,10 +479,15 @@ class Trainer:
     def val_loaders(self):
         """Get a zip of all validation loaders
 
+        If opts.data.val.resident, validation batches come from memory, see
+        data.ResidentLoader
+
         Returns:
             generator: zip generator yielding tuples:
                 (batch_rf, batch_rn, batch_sf, batch_sn)
         """
+        if self.multi_domain_loaders and "val" in self.multi_domain_loaders:
+            return self.multi_domain_loaders["val"]
         return zip(*list(self.loaders["val"].values()))
 
     def run_epoch(self):
@@ -349,6 +523,12 @@ class Trainer:
                 for param in self.D.parameters():
                     param.requires_grad = False
 
+            # spectral norms' power iterations run once per step, not once
+            # per forward pass, so fusing domains doesn't change them
+            for model in [self.G, self.D]:
+                if model is not None:
+                    power_iteration_per_step(model)
+
             # ------------------------------
             # -----  Update Generator  -----
             # ------------------------------
@@ -376,6 +556,7 @@ class Trainer:
             self.logger.global_step += 1
             step_time = time() - step_start_time
             self.log_step_time(step_time)
+            self.log_data_timings(multi_batch_tuple)
 
         for d in self.opts.domains:
             self.log_comet_images("train", d)
@@ -394,16 +575,48 @@ class Trainer:
         if self.exp:
             self.exp.log_metric("Step-time", step_time, step=self.logger.global_step)
 
+    def log_data_timings(self, multi_batch_tuple):
+        """Logs on comet.ml the time DataLoader workers spent in each stage of
+        loading the step's samples (see data.loaders.timings): per domain and
+        stage, per worker and as a histogram of the samples' loading times
+
+        Args:
+            multi_batch_tuple (tuple): the step's batches
+        """
+        if not self.exp:
+            return
+        metrics = {}
+        sample_times = []
+        for batch in multi_batch_tuple:
+            if "timings" not in batch:
+                continue
+            timings = dict(batch["timings"])
+            workers = timings.pop("worker").tolist()
+            for stage, times in timings.items():
+                metrics["Data-time/{}/{}".format(batch["domain"][0], stage)] = (
+                    times.sum().item()
+                )
+            per_sample = sum(timings.values()).tolist()
+            for worker, t in zip(workers, per_sample):
+                key = "Data-time/worker-{}".format(worker)
+                metrics[key] = metrics.get(key, 0.0) + t
+            sample_times += per_sample
+        if not metrics:
+            return
+        step = self.logger.global_step
+        self.exp.log_metrics(metrics, step=step)
+        self.exp.log_histogram_3d(sample_times, name="Data-time", step=step)
+
     def log_comet_images(self, mode, domain):
 
         save_images = {}
         if domain != "rf":
-            for im_set in self.display_images[mode][domain]:
-                x = im_set["data"]["x"].unsqueeze(0).to(self.device)
+            for im_set in self.display_images.items(mode, domain):
+                x = im_set["x"]
                 self.z = self.G.encode(x)
 
-                for update_task, update_target in im_set["data"].items():
-                    target = im_set["data"][update_task].unsqueeze(0).to(self.device)
+                for update_task, update_target in im_set.items():
+                    target = update_target
                     task_saves = []
 
                     if update_task != "x":
@@ -441,11 +654,11 @@ class Trainer:
                 )
         else:
             image_outputs = []
-            for im_set in self.display_images[mode][domain]:
-                x = im_set["data"]["x"].unsqueeze(0).to(self.device)
-                m = im_set["data"]["m"].unsqueeze(0).to(self.device)
+            for im_set in self.display_images.items(mode, domain):
+                x = im_set["x"]
+                m = im_set["m"]
 
-                z = self.sample_z(x.shape[0])
+                z = self.sample_z(x.shape[0], x.shape[-2:])
                 prediction = self.G.painter(z, x * (1.0 - m))
                 image_outputs.append(x * (1.0 - m))
                 image_outputs.append(prediction)
@@ -466,11 +679,11 @@ class Trainer:
     def log_comet_combined_images(self, mode, domain):
 
         image_outputs = []
-        for im_set in self.display_images[mode][domain]:
-            x = im_set["data"]["x"].unsqueeze(0).to(self.device)
-            # m = im_set["data"]["m"].unsqueeze(0).to(self.device)
+        for im_set in self.display_images.items(mode, domain):
+            x = im_set["x"]
+            # m = im_set["m"]
 
-            z = self.sample_z(x.shape[0])
+            z = self.sample_z(x.shape[0], x.shape[-2:])
             m = self.G.decoders["m"](self.G.encode(x))
 
             prediction = self.G.painter(z, x * (1.0 - m))
@@ -562,12 +775,16 @@ class Trainer:
         """Perform an update on g from multi_domain_batch which is a dictionary
         domain => batch
 
-        * compute loss
+        * compute loss, autocast to opts.train.amp.dtype with mixed precision
             * if using Sam Lavoie's representational_training:
                 * compute either representation_loss or translation_loss
                   depending on the current step vs opts.train.representation_steps
             * otherwise compute both
-        * loss.backward()
+        * loss.backward(), scaled with float16 mixed precision
+        * latent vectors are kept for update_d and update_c, see encode
+        * the above is repeated on each micro-batch, see micro_batches,
+          gradients are accumulated and logged losses averaged, weighted by
+          the micro-batches' sizes
         * g_opt_step()
             * g_opt.step() or .extrapolation() depending on self.logger.global_step
         * logs losses on comet.ml with self.log_losses(model_to_update="G")
@@ -576,8 +793,20 @@ class Trainer:
             multi_domain_batch (dict): dictionnary of domain batches
         """
         self.g_opt.zero_grad()
-        g_loss = self.get_g_loss(multi_domain_batch, verbose)
-        g_loss.backward()
+        micro_batches = self.micro_batches(multi_domain_batch)
+        micro_losses = []
+        for micro_batch, latents, weight in micro_batches:
+            # new step: G's losses compute the latent vectors again
+            latents.clear()
+            self.latents = latents
+            with self.autocast():
+                g_loss = self.get_g_loss(micro_batch, verbose)
+            self.scale_loss("G", g_loss * weight).backward()
+            self.detach_latents()
+            micro_losses.append(
+                div_dict(deepcopy(self.logger.losses.generator), 1 / weight)
+            )
+        self.logger.losses.generator = reduce(sum_dict, micro_losses)
         self.g_opt_step()
         self.log_losses(model_to_update="G", mode="train")
 
@@ -601,13 +830,14 @@ class Trainer:
         step_loss = 0
         lambdas = self.opts.train.lambdas
         one_hot = self.opts.classifier.loss != "cross_entropy"
+        self.encode_domains(multi_domain_batch, tasks=list(self.G.decoders))
         for batch_domain, batch in multi_domain_batch.items():
             # We don't care about the flooded domain here
             if batch_domain == "rf":
                 continue
 
             x = batch["data"]["x"]
-            self.z = self.G.encode(x)
+            self.z = self.encode(batch_domain, x)
             # ---------------------------------
             # -----  classifier loss (1)  -----
             # ---------------------------------
@@ -630,7 +860,7 @@ class Trainer:
             # -------------------------------------------------
             for update_task, update_target in batch["data"].items():
                 if update_task not in {"m", "p", "x"}:
-                    prediction = self.G.decoders[update_task](self.z)
+                    prediction = self.decode(batch_domain, x, update_task)
                     update_loss = self.losses["G"]["tasks"][update_task](
                         prediction, update_target
                     )
@@ -643,7 +873,7 @@ class Trainer:
                 # REFACTOR CONTINUE HERE
                 elif update_task == "m":
                     # ? output features classifier
-                    prediction = self.G.decoders[update_task](self.z)
+                    prediction = self.decode(batch_domain, x, "m")
                     # Main loss first:
 
                     update_loss = (
@@ -687,14 +917,179 @@ class Trainer:
                         ] = update_loss.item()
         return step_loss
 
-    def sample_z(self, batch_size):
-        return (
-            torch.empty(
-                batch_size,
-                self.opts.gen.p.latent_dim,
-                self.painter_z_h,
-                self.painter_z_w,
+    def micro_batches(self, multi_domain_batch):
+        """Splits each domain's batch into opts.train.accumulate_steps
+        micro-batches (fewer if a domain's batch is smaller) whose gradients
+        are accumulated before a single optimizer step.
+
+        The split is computed once per multi_domain_batch so that the G, D and
+        C updates of a step share the micro-batches and their latent caches
+
+        Args:
+            multi_domain_batch (dict): dictionnary mapping domain names to
+                batches from the trainer's loaders
+
+        Returns:
+            list: (micro multi_domain_batch, latent cache, weight) tuples where
+                weight is the micro-batch's share of the samples, by which its
+                losses are multiplied
+        """
+        if (
+            self.split is None
+            or self.split[0] is not multi_domain_batch
+            or self.split[1] != self.accumulate_steps
+        ):
+            n = min(
+                [self.accumulate_steps]
+                + [len(batch["domain"]) for batch in multi_domain_batch.values()]
             )
+            if n == 1:
+                micro_batches = [multi_domain_batch]
+            else:
+                splits = {
+                    domain: split_batch(batch, n)
+                    for domain, batch in multi_domain_batch.items()
+                }
+                micro_batches = [
+                    {domain: splits[domain][i] for domain in splits} for i in range(n)
+                ]
+            total = sum(len(b["domain"]) for b in multi_domain_batch.values())
+            self.split = (
+                multi_domain_batch,
+                self.accumulate_steps,
+                [
+                    (b, {}, sum(len(d["domain"]) for d in b.values()) / total)
+                    for b in micro_batches
+                ],
+            )
+        return self.split[2]
+
+    def cached(self, domain, x, key, detach=False):
+        """Latent vector ("z") or task prediction (e.g. "m") of x, the current
+        step's batch from domain, if it was already computed, see encode
+
+        Returns:
+            torch.Tensor: the cached tensor, None if it needs to be computed (G
+                losses need gradients and the cached one was detached)
+        """
+        cached = self.latents.get(domain)
+        if cached is None or cached["x"] is not x or key not in cached:
+            return None
+        if not (detach or cached[key].requires_grad):
+            return None
+        return cached[key].detach() if detach else cached[key]
+
+    def encode(self, domain, x, detach=False):
+        """Latent vector of x, the current step's batch from domain: it is
+        computed once and shared by the G, D and C losses.
+
+        G losses get the gradient-carrying tensor (computed again if the cached
+        one was detached by a backward pass), D and C a detached one (computed
+        without a graph if not cached)
+
+        Args:
+            domain (str): the batch's domain
+            x (torch.Tensor): the batch's images
+            detach (bool, optional): whether no gradient flows to G.
+                Defaults to False.
+
+        Returns:
+            torch.Tensor: G.encode(x)
+        """
+        z = self.cached(domain, x, "z", detach)
+        if z is None:
+            with torch.set_grad_enabled(torch.is_grad_enabled() and not detach):
+                z = self.G.encode(x)
+            self.latents[domain] = {"x": x, "z": z}
+            z = z.detach() if detach else z
+        return z
+
+    def decode(self, domain, x, task, detach=False):
+        """Prediction G.decoders[task] on x, cached with its latent vector, see
+        encode
+        """
+        prediction = self.cached(domain, x, task, detach)
+        if prediction is None:
+            z = self.encode(domain, x, detach)
+            with torch.set_grad_enabled(torch.is_grad_enabled() and not detach):
+                prediction = self.G.decoders[task](z)
+            self.latents[domain][task] = prediction
+        return prediction
+
+    def encode_domains(self, multi_domain_batch, tasks=(), detach=False):
+        """With opts.train.fuse_domains, fills the cache (see encode) of all
+        non-rf domains at once: batches of the same size are concatenated to
+        run G.encode and each of tasks' decoders once, the outputs are then
+        split back per domain. Does nothing otherwise
+
+        Args:
+            multi_domain_batch (dict): dictionnary mapping domain names to
+                batches from the trainer's loaders
+            tasks (iterable, optional): decoders to run on the domains which
+                have a target for them. Defaults to ().
+            detach (bool, optional): whether no gradient flows to G.
+                Defaults to False.
+        """
+        if not self.fuse_domains:
+            return
+        groups = {}
+        for domain, batch in multi_domain_batch.items():
+            if domain != "rf":
+                x = batch["data"]["x"]
+                groups.setdefault(tuple(x.shape[1:]), []).append(domain)
+        for domains in groups.values():
+            x = {d: multi_domain_batch[d]["data"]["x"] for d in domains}
+            with torch.set_grad_enabled(torch.is_grad_enabled() and not detach):
+                missing = [
+                    d for d in domains if self.cached(d, x[d], "z", detach) is None
+                ]
+                if len(missing) > 1:
+                    z = self.G.encode(torch.cat([x[d] for d in missing]))
+                    sizes = [len(x[d]) for d in missing]
+                    for d, z_d in zip(missing, z.split(sizes)):
+                        self.latents[d] = {"x": x[d], "z": z_d}
+                for task in tasks:
+                    missing = [
+                        d
+                        for d in domains
+                        if task in multi_domain_batch[d]["data"]
+                        and self.cached(d, x[d], task, detach) is None
+                    ]
+                    if len(missing) < 2:
+                        continue
+                    z = torch.cat([self.encode(d, x[d], detach) for d in missing])
+                    prediction = self.G.decoders[task](z)
+                    sizes = [len(x[d]) for d in missing]
+                    for d, p_d in zip(missing, prediction.split(sizes)):
+                        self.latents[d][task] = p_d
+
+    def detach_latents(self):
+        """Once G's loss was back-propagated, cached latent vectors and
+        predictions can only be reused by D and C: free their graphs
+        """
+        for cached in self.latents.values():
+            for key, tensor in cached.items():
+                if key != "x":
+                    cached[key] = tensor.detach()
+
+    def sample_z(self, batch_size, size=None):
+        """Samples the painter's input noise
+
+        Args:
+            batch_size (int): number of samples
+            size (tuple, optional): (h, w) of the images to paint, which can
+                change from batch to batch with data.buckets. Defaults to None,
+                the input size computed in setup.
+
+        Returns:
+            torch.Tensor: batch_size x latent_dim x z_h x z_w noise
+        """
+        z_h, z_w = self.painter_z_h, self.painter_z_w
+        if size is not None:
+            z_h = size[0] // (2 ** self.opts.gen.p.spade_n_up)
+            z_w = size[1] // (2 ** self.opts.gen.p.spade_n_up)
+        return (
+            torch.empty(batch_size, self.opts.gen.p.latent_dim, z_h, z_w)
             .normal_(mean=0, std=1.0)
             .to(self.device)
         )
@@ -710,7 +1105,6 @@ class Trainer:
             torch.Tensor: scalar loss tensor, weighted according to opts.train.lambdas
         """
         step_loss = 0
-        self.g_opt.zero_grad()
         lambdas = self.opts.train.lambdas
 
         for batch_domain, batch in multi_domain_batch.items():
@@ -720,7 +1114,7 @@ class Trainer:
 
             x = batch["data"]["x"]
             m = batch["data"]["m"]  # ! different mask: hides water to be reconstructed
-            z = self.sample_z(x.shape[0])
+            z = self.sample_z(x.shape[0], x.shape[-2:])
             masked_x = x * (1.0 - m)
 
             fake_flooded = self.G.painter(z, masked_x)
@@ -818,13 +1212,12 @@ class Trainer:
                 continue
 
             x = batch["data"]["x"]
-            self.z = self.G.encode(x)
+            self.z = self.encode(batch_domain, x)
 
-            update_task = "m"
             # Get mask from masker
-            m = self.G.decoders[update_task](self.z)
+            m = self.decode(batch_domain, x, "m")
 
-            z = self.sample_z(x.shape[0])
+            z = self.sample_z(x.shape[0], x.shape[-2:])
             masked_x = x * (1.0 - m)
 
             fake_flooded = self.G.painter(z, masked_x)
@@ -853,12 +1246,21 @@ class Trainer:
         # ? split representational as in update_g
         # ? repr: domain-adaptation traduction
         self.d_opt.zero_grad()
-        d_loss = self.get_d_loss(multi_domain_batch, verbose)
-
-        d_loss.backward()
+        micro_batches = self.micro_batches(multi_domain_batch)
+        micro_losses = []
+        for micro_batch, latents, weight in micro_batches:
+            self.latents = latents
+            with self.autocast():
+                d_loss = self.get_d_loss(micro_batch, verbose)
+
+            self.scale_loss("D", d_loss * weight).backward()
+            self.logger.losses.discriminator.total_loss = d_loss.item()
+            micro_losses.append(
+                div_dict(deepcopy(self.logger.losses.discriminator), 1 / weight)
+            )
+        self.logger.losses.discriminator = reduce(sum_dict, micro_losses)
         self.d_opt_step()
 
-        self.logger.losses.discriminator.total_loss = d_loss.item()
         self.log_losses(model_to_update="D", mode="train")
 
     def get_d_loss(self, multi_domain_batch, verbose=0):
@@ -886,6 +1288,8 @@ class Trainer:
         """
 
         disc_loss = {"m": {"Advent": 0}, "p": {"global": 0, "local": 0}}
+        if "m" in self.opts.tasks and self.opts.gen.m.use_advent:
+            self.encode_domains(multi_domain_batch, tasks=["m"], detach=True)
 
         for batch_domain, batch in multi_domain_batch.items():
             x = batch["data"]["x"]
@@ -893,7 +1297,7 @@ class Trainer:
 
             if batch_domain == "rf":
                 # sample vector
-                z_paint = self.sample_z(x.shape[0])
+                z_paint = self.sample_z(x.shape[0], x.shape[-2:])
                 fake = self.G.painter(z_paint, x * (1.0 - m))
                 fake_d_global = self.D["p"]["global"](fake)
                 real_d_global = self.D["p"]["global"](x)
@@ -919,15 +1323,13 @@ class Trainer:
                     disc_loss["p"]["local"] += local_loss / num_D
 
             else:
-                z = self.G.encode(x)
                 if "m" in self.opts.tasks:
                     if self.opts.gen.m.use_advent:
                         if verbose > 0:
                             print("Now training the ADVENT discriminator!")
-                        fake_mask = self.G.decoders["m"](z)
+                        fake_mask = self.decode(batch_domain, x, "m", detach=True)
                         fake_complementary_mask = 1 - fake_mask
                         prob = torch.cat([fake_mask, fake_complementary_mask], dim=1)
-                        prob = prob.detach()
 
                         if batch_domain == "r":
                             loss_main = self.losses["D"]["advent"](
@@ -975,10 +1377,16 @@ class Trainer:
 
         """
         self.c_opt.zero_grad()
-        c_loss = self.get_classifier_loss(multi_domain_batch)
+        micro_batches = self.micro_batches(multi_domain_batch)
+        c_losses = []
+        for micro_batch, latents, weight in micro_batches:
+            self.latents = latents
+            with self.autocast():
+                c_loss = self.get_classifier_loss(micro_batch)
+            c_losses.append(c_loss.item() * weight)
+            self.scale_loss("C", c_loss * weight).backward()
         # ? Log policy
-        self.logger.losses.classifier = c_loss.item()
-        c_loss.backward()
+        self.logger.losses.classifier = sum(c_losses)
         self.c_opt_step()
 
     def get_classifier_loss(self, multi_domain_batch):
@@ -994,11 +1402,12 @@ class Trainer:
         loss = 0
         lambdas = self.opts.train.lambdas
         one_hot = self.opts.classifier.loss != "cross_entropy"
+        self.encode_domains(multi_domain_batch, detach=True)
         for batch_domain, batch in multi_domain_batch.items():
             # We don't care about the flooded domain here
             if batch_domain == "rf":
                 continue
-            self.z = self.G.encode(batch["data"]["x"])
+            self.z = self.encode(batch_domain, batch["data"]["x"], detach=True)
             # Forward through classifier, output classifier = (batch_size, 4)
             output_classifier = self.C(self.z)
             # Cross entropy loss (with sigmoid)
@@ -1065,6 +1474,10 @@ class Trainer:
         if self.D is not None and get_num_params(self.D) > 0:
             save_dict["D"] = self.D.state_dict()
             save_dict["d_opt"] = self.d_opt.state_dict()
+        if self.scalers:
+            save_dict["scalers"] = {
+                model: scaler.state_dict() for model, scaler in self.scalers.items()
+            }
 
         torch.save(save_dict, save_path)
 
@@ -1114,6 +1527,11 @@ class Trainer:
             if not ("m" in self.opts.tasks and "p" in self.opts.tasks):
                 self.d_opt.load_state_dict(checkpoint["d_opt"])
 
+        # float16 loss scales, if the checkpoint used them
+        for model, state in checkpoint.get("scalers", {}).items():
+            if model in self.scalers:
+                self.scalers[model].load_state_dict(state)
+
     def get_latest_ckpt(self):
         load_dir = Path(self.opts.output_path) / Path("checkpoints")
         ckpts = os.listdir(str(load_dir.resolve()))
@@ -1133,11 +1551,11 @@ class Trainer:
         for key in metrics.keys():
             metric_avg_scores[key] = 0.0
         if domain != "rf":
-            for im_set in self.display_images[mode][domain]:
-                x = im_set["data"]["x"].unsqueeze(0).to(self.device)
-                m = im_set["data"]["m"].unsqueeze(0).to(self.device).detach().numpy()
+            for im_set in self.display_images.items(mode, domain):
+                x = im_set["x"]
+                m = im_set["m"].detach().cpu().numpy()
                 z = self.G.encode(x)
-                pred_mask = self.G.decoders["m"](z).detach().numpy()
+                pred_mask = self.G.decoders["m"](z).detach().cpu().numpy()
                 # Binarize mask
                 pred_mask[pred_mask > 0.5] = 1.0
 
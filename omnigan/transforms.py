@@ -15,6 +15,27 @@ def interpolation(task):
         return "bilinear"  # "bilinear"
 
 
+def nearest_indices(in_size, out_size):
+    """Indices of the source pixels F.interpolate(mode="nearest") samples,
+    computed in float32 like F.interpolate
+    """
+    scale = np.float32(in_size) / np.float32(out_size)
+    indices = np.floor(np.arange(out_size, dtype=np.float32) * scale)
+    return np.minimum(indices.astype(np.int64), in_size - 1)
+
+
+def interpolate(tensor, size, task):
+    """F.interpolate for any dtype: uint8 and float16 tensors (see
+    data.loaders.transport) are resized as float32 and converted back
+    """
+    if tensor.dtype == torch.float32:
+        return F.interpolate(tensor, size, mode=interpolation(task))
+    resized = F.interpolate(tensor.float(), size, mode=interpolation(task))
+    if not tensor.is_floating_point():
+        resized = resized.round()
+    return resized.to(tensor.dtype)
+
+
 class Resize:
     def __init__(self, target_size):
         assert isinstance(target_size, (int, tuple, list))
@@ -29,10 +50,13 @@ class Resize:
 
     def __call__(self, data):
         return {
-            task: F.interpolate(tensor, (self.h, self.w), mode=interpolation(task))
+            task: interpolate(tensor, (self.h, self.w), task)
             for task, tensor in data.items()
         }
 
+    def __repr__(self):
+        return "Resize({}, {})".format(self.h, self.w)
+
 
 class RandomCrop:
     def __init__(self, size):
@@ -40,21 +64,39 @@ class RandomCrop:
         if not isinstance(size, int):
             self.h, self.w = size
         else:
-            assert len(size == 2)
             self.h = self.w = size
 
         self.h = int(self.h)
         self.w = int(self.w)
 
     def __call__(self, data):
-        h, w = data["x"].size[-2:]
-        top = np.random.randint(0, h - self.h)
-        left = np.random.randint(0, w - self.w)
+        h, w = data["x"].shape[-2:]
+        top = np.random.randint(0, h - self.h + 1)
+        left = np.random.randint(0, w - self.w + 1)
+        return {
+            task: tensor[..., top : top + self.h, left : left + self.w]
+            for task, tensor in data.items()
+        }
+
+    def __repr__(self):
+        return "RandomCrop({}, {})".format(self.h, self.w)
+
+
+class CenterCrop(RandomCrop):
+    """Deterministic RandomCrop, used for validation samples"""
+
+    def __call__(self, data):
+        h, w = data["x"].shape[-2:]
+        top = (h - self.h) // 2
+        left = (w - self.w) // 2
         return {
-            task: tensor[:, top : top + self.h, left + self.w]
+            task: tensor[..., top : top + self.h, left : left + self.w]
             for task, tensor in data.items()
         }
 
+    def __repr__(self):
+        return "CenterCrop({}, {})".format(self.h, self.w)
+
 
 class RandomHorizontalFlip:
     def __init__(self, p=0.5):
@@ -64,9 +106,215 @@ class RandomHorizontalFlip:
     def __call__(self, data):
         if np.random.rand() > self.p:
             return data
+        return {task: torch.flip(tensor, (-1,)) for task, tensor in data.items()}
+
+    def __repr__(self):
+        return "RandomHorizontalFlip({})".format(self.p)
+
+
+class BatchAugment:
+    def __init__(self, transforms):
+        """Applies a sequence of RandomHorizontalFlip, RandomCrop and Resize
+        transforms to a whole batch at once, with different random parameters
+        for each sample: the sequence is turned into one sampling window per
+        sample and all tasks are resampled with a single grid.
+
+        Args:
+            transforms (list): geometric transforms, in order
+        """
+        for t in transforms:
+            assert isinstance(
+                t, (Resize, RandomCrop, RandomHorizontalFlip)
+            ), "Unknown batch transform {}".format(t)
+        self.transforms = transforms
+
+    def sample_windows(self, n, h, w):
+        """Samples the transforms' random parameters for n images of size h x w
+
+        Returns:
+            tuple: (windows, flips, (out_h, out_w), (rows, cols)) where windows is
+                an n x 4 array of (top, left, height, width) in the input images'
+                coordinates and rows and cols are n x out_h and n x out_w arrays
+                of the input pixels the transforms sample with nearest
+                interpolation
+        """
+        windows = np.tile(np.array([0.0, 0.0, h, w]), (n, 1))
+        flips = np.zeros(n, dtype=bool)
+        rows = np.tile(np.arange(h), (n, 1))
+        cols = np.tile(np.arange(w), (n, 1))
+        ch, cw = h, w
+        for t in self.transforms:
+            if isinstance(t, Resize):
+                rows = rows[:, nearest_indices(ch, t.h)]
+                cols = cols[:, nearest_indices(cw, t.w)]
+                ch, cw = t.h, t.w
+            elif isinstance(t, RandomHorizontalFlip):
+                flipped = np.random.rand(n) <= t.p
+                flips ^= flipped
+                cols = np.where(flipped[:, None], cols[:, ::-1], cols)
+            elif isinstance(t, CenterCrop):
+                top = np.full(n, (ch - t.h) // 2)
+                left = np.full(n, (cw - t.w) // 2)
+            elif isinstance(t, RandomCrop):
+                top = np.random.randint(0, ch - t.h + 1, n)
+                left = np.random.randint(0, cw - t.w + 1, n)
+            if isinstance(t, RandomCrop):
+                # index maps follow the flips, windows are flipped at the end
+                rows = np.take_along_axis(rows, top[:, None] + np.arange(t.h), 1)
+                cols = np.take_along_axis(cols, left[:, None] + np.arange(t.w), 1)
+                # flipped samples are cropped from the right of their window
+                left = np.where(flips, cw - t.w - left, left)
+                sy = windows[:, 2] / ch
+                sx = windows[:, 3] / cw
+                windows = np.stack(
+                    [
+                        windows[:, 0] + top * sy,
+                        windows[:, 1] + left * sx,
+                        t.h * sy,
+                        t.w * sx,
+                    ],
+                    axis=1,
+                )
+                ch, cw = t.h, t.w
+        return windows, flips, (ch, cw), (rows, cols)
+
+    def __call__(self, data):
+        """Augments a batch
+
+        Args:
+            data (dict): {task: N x C x H x W tensor}
+
+        Returns:
+            dict: {task: augmented N x C x out_h x out_w tensor}
+        """
+        n, _, h, w = data["x"].shape
+        windows, flips, out_size, _ = self.sample_windows(n, h, w)
+        return self.resample(data, windows, flips, out_size)
+
+    @staticmethod
+    def resample(data, windows, flips, out_size):
+        """Resamples the windows of a batch, see sample_windows
+
+        Args:
+            data (dict): {task: N x C x H x W tensor}
+            windows (np.array): N x 4 (top, left, height, width) windows
+            flips (np.array): N booleans, whether to flip the windows
+            out_size (tuple): (out_h, out_w)
+
+        Returns:
+            dict: {task: N x C x out_h x out_w tensor}
+        """
+        x = data["x"]
+        n, _, h, w = x.shape
+        top, left, height, width = torch.from_numpy(windows).float().t()
+        sign = 1.0 - 2.0 * torch.from_numpy(flips).float()
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = sign * width / w
+        theta[:, 0, 2] = (2 * left + width) / w - 1
+        theta[:, 1, 1] = height / h
+        theta[:, 1, 2] = (2 * top + height) / h - 1
+        grid = F.affine_grid(
+            theta.to(x.device), (n, 1) + tuple(out_size), align_corners=False
+        )
+
+        # tasks sharing an interpolation mode are resampled together
+        augmented = {}
+        for mode in ["bilinear", "nearest"]:
+            tasks = [task for task in data if interpolation(task) == mode]
+            if not tasks:
+                continue
+            stacked = torch.cat([data[task].float() for task in tasks], dim=1)
+            # border padding clamps samples at the edges like F.interpolate
+            stacked = F.grid_sample(
+                stacked, grid, mode=mode, padding_mode="border", align_corners=False
+            )
+            for task, tensor in zip(
+                tasks, stacked.split([data[t].shape[1] for t in tasks], dim=1)
+            ):
+                if not data[task].is_floating_point():
+                    tensor = tensor.round()
+                augmented[task] = tensor.to(data[task].dtype)
+        return augmented
+
+
+class FusedGeometric:
+    def __init__(self, transforms):
+        """Applies consecutive RandomHorizontalFlip, RandomCrop and Resize
+        transforms to a sample as a single resampling: their random parameters
+        are sampled as one window of the input (see BatchAugment.sample_windows).
+        Tasks resized with nearest interpolation are gathered at the input
+        pixels the transforms would sample, giving the same output as the
+        sequential transforms, and bilinear ones are interpolated once from the
+        window. Windows which are plain crops are sliced without interpolating.
+
+        Args:
+            transforms (list): geometric transforms, in order
+        """
+        self.transforms = list(transforms)
+        self.plan = BatchAugment(self.transforms)
+
+    def __call__(self, data):
+        h, w = data["x"].shape[-2:]
+        windows, flips, (out_h, out_w), (rows, cols) = self.plan.sample_windows(
+            1, h, w
+        )
+        top, left, height, width = windows[0]
+        if (height, width) == (out_h, out_w) and np.allclose(
+            windows, np.round(windows)
+        ):
+            top, left = int(round(top)), int(round(left))
+            data = {
+                task: tensor[..., top : top + out_h, left : left + out_w]
+                for task, tensor in data.items()
+            }
+            if flips[0]:
+                data = {task: torch.flip(t, (-1,)) for task, t in data.items()}
+            return data
+        bilinear = {t: v for t, v in data.items() if interpolation(t) != "nearest"}
+        resampled = self.plan.resample(bilinear, windows, flips, (out_h, out_w))
+        rows, cols = torch.from_numpy(rows[0]), torch.from_numpy(cols[0])
         for task, tensor in data.items():
-            print(task, tensor.shape)
-        return {task: torch.flip(tensor, (1,)) for task, tensor in data.items()}
+            if task not in bilinear:
+                resampled[task] = tensor[..., rows[:, None], cols]
+        return {task: resampled[task] for task in data}
+
+    def __repr__(self):
+        return "FusedGeometric({})".format(", ".join(map(repr, self.transforms)))
+
+
+def fuse_geometric(transforms):
+    """Replaces runs of 2 or more consecutive Resize, RandomCrop and
+    RandomHorizontalFlip transforms by a FusedGeometric
+
+    Args:
+        transforms (list): transforms
+
+    Returns:
+        list: fused transforms
+    """
+    fused = []
+    run = []
+    for t in list(transforms) + [None]:
+        if isinstance(t, (Resize, RandomCrop, RandomHorizontalFlip)):
+            run.append(t)
+            continue
+        fused += [FusedGeometric(run)] if len(run) > 1 else run
+        run = []
+        if t is not None:
+            fused.append(t)
+    return fused
+
+
+def unfuse_geometric(transforms):
+    """Inverse of fuse_geometric
+
+    Returns:
+        tuple: (unfused transforms, whether transforms had fused ones)
+    """
+    unfused = []
+    for t in transforms:
+        unfused += t.transforms if isinstance(t, FusedGeometric) else [t]
+    return unfused, len(unfused) != len(transforms)
 
 
 class ToTensor:
@@ -95,7 +343,8 @@ class Normalize:
     def __init__(self):
 
         # self.normImage = trsfs.Normalize(([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]))
-        self.normImage = trsfs.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        # tensor_loader's images are in [0, 255], normalize them to [-1, 1]
+        self.normImage = trsfs.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5))
         self.normDepth = lambda x: x  # trsfs.Normalize([1 / 255], [1 / 3])
         self.normMask = lambda x: x
 
@@ -112,6 +361,22 @@ class Normalize:
             for task, tensor in data.items()
         }
 
+    def __repr__(self):
+        return "Normalize()"
+
+
+class Squeeze:
+    """Only removes the loaders' leading dimension: used instead of Normalize
+    when data.loaders.transport is uint8 as normalization then happens in
+    Trainer.batch_to_device
+    """
+
+    def __call__(self, data):
+        return {task: tensor.squeeze(0) for task, tensor in data.items()}
+
+    def __repr__(self):
+        return "Squeeze()"
+
 
 def get_transform(transform_item):
     """Returns the torchivion transform function associated to a
@@ -134,15 +399,143 @@ def get_transform(transform_item):
     raise ValueError("Unknown transform_item {}".format(transform_item))
 
 
-def get_transforms(opts):
-    """Get all the transform functions listed in opts.data.transforms
-    using get_transform(transform_item)
+def get_decode_size(transforms):
+    """Size (h, w) of the first Resize in transforms if it is only preceded by
+    flips, which commute with resizing, so that data can be decoded at that size
+
+    Args:
+        transforms (list): transforms, as returned by get_transforms
+
+    Returns:
+        tuple: (h, w) or None
     """
-    last_transforms = [Normalize()]
+    for t in unfuse_geometric(transforms)[0]:
+        if isinstance(t, Resize):
+            return (t.h, t.w)
+        if not isinstance(t, RandomHorizontalFlip):
+            return None
+    return None
 
+
+def get_conf_transforms(opts):
+    """Get the transform functions listed in opts.data.transforms
+    using get_transform(transform_item)
+    """
     conf_transforms = []
     for t in opts.data.transforms:
         if get_transform(t) is not None:
             conf_transforms.append(get_transform(t))
+    return conf_transforms
+
+
+def make_deterministic(transforms):
+    """Removes the horizontal flips of a list of transforms and replaces their
+    random crops by center crops
+
+    Args:
+        transforms (list): transforms, as returned by get_conf_transforms
+
+    Returns:
+        list: deterministic transforms
+    """
+    return [
+        CenterCrop((t.h, t.w)) if isinstance(t, RandomCrop) else t
+        for t in transforms
+        if not isinstance(t, RandomHorizontalFlip)
+    ]
+
+
+def get_transforms(opts, deterministic=False):
+    """Get all the transform functions listed in opts.data.transforms
+    using get_transform(transform_item), followed by Normalize.
+
+    If deterministic, flips are removed and crops are center crops, see
+    make_deterministic
+
+    If opts.data.augmentation is "batch", only the deterministic transforms are
+    returned, random ones are applied on batches by get_batch_augment(opts)
+
+    If opts.data.loaders.transport is "uint8", Normalize is replaced by Squeeze
+
+    If opts.data.fuse_transforms, consecutive geometric transforms are applied
+    as a single resampling, see FusedGeometric
+    """
+    if opts.data.loaders.get("transport", "float32") == "uint8":
+        last_transforms = [Squeeze()]
+    else:
+        last_transforms = [Normalize()]
+
+    conf_transforms = get_conf_transforms(opts)
+    if deterministic:
+        conf_transforms = make_deterministic(conf_transforms)
+    elif opts.data.get("augmentation", "workers") == "batch":
+        conf_transforms, _ = split_deterministic(conf_transforms)
+    if opts.data.get("fuse_transforms", False):
+        conf_transforms = fuse_geometric(conf_transforms)
 
     return conf_transforms + last_transforms
+
+
+def get_batch_augment(opts):
+    """Get the BatchAugment applying the random transforms listed in
+    opts.data.transforms on batches if opts.data.augmentation is "batch"
+
+    Returns:
+        BatchAugment: None if augmentations are done in the DataLoader workers
+    """
+    if opts.data.get("augmentation", "workers") != "batch":
+        return None
+    _, random_transforms = split_deterministic(get_conf_transforms(opts))
+    return BatchAugment(random_transforms)
+
+
+def scale_transforms(transforms, size):
+    """Scales the Resize and RandomCrop transforms of a list so that the images
+    it outputs are of size (h, w) instead of the size of its last Resize or
+    RandomCrop, used to get each aspect ratio bucket's transforms
+    (see data.AspectRatioBucketSampler)
+
+    Args:
+        transforms (list): transforms, as returned by get_transforms
+        size (tuple): (h, w) output size
+
+    Returns:
+        list: scaled transforms, other transforms are kept as is
+    """
+    transforms, fused = unfuse_geometric(transforms)
+    sized = [t for t in transforms if isinstance(t, (Resize, RandomCrop))]
+    if not sized:
+        scaled = [Resize(size)] + list(transforms)
+        return fuse_geometric(scaled) if fused else scaled
+    sy = size[0] / sized[-1].h
+    sx = size[1] / sized[-1].w
+    scaled = []
+    for t in transforms:
+        if isinstance(t, (Resize, RandomCrop)):
+            t = type(t)((int(round(t.h * sy)), int(round(t.w * sx))))
+        scaled.append(t)
+    return fuse_geometric(scaled) if fused else scaled
+
+
+def split_deterministic(transforms):
+    """Splits a list of transforms into the deterministic Resize transforms which
+    can be applied first, and the rest. Horizontal flips commute with resizing so
+    hflip -> resize -> crop -> resize is split as [resize], [hflip, crop, resize]
+
+    Args:
+        transforms (list): transforms as returned by get_transforms
+
+    Returns:
+        tuple: (deterministic_transforms, other_transforms)
+    """
+    transforms, fused = unfuse_geometric(transforms)
+    cut = len(transforms)
+    for i, t in enumerate(transforms):
+        if not isinstance(t, (Resize, RandomHorizontalFlip)):
+            cut = i
+            break
+    deterministic = [t for t in transforms[:cut] if isinstance(t, Resize)]
+    others = [t for t in transforms[:cut] if not isinstance(t, Resize)]
+    if fused:
+        return deterministic, fuse_geometric(others + transforms[cut:])
+    return deterministic, others + transforms[cut:]
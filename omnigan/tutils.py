@@ -1,5 +1,6 @@
 """Tensor-utils
 """
+from functools import lru_cache
 from pathlib import Path
 
 # from copy import copy
@@ -7,7 +8,6 @@ from threading import Thread
 
 import numpy as np
 import torch
-from torch.autograd import Variable
 from skimage import io as skio
 from torch.nn import init
 
@@ -176,6 +176,53 @@ def get_normalized_depth_t(arr, domain, normalize=False):
     return arr
 
 
+# number of integers q = 992 * R' + 32 * G' + B' for R', G', B' in [0, 255]
+UNITY_DEPTH_CODES = 992 * 255 + 32 * 255 + 255 + 1
+
+
+def pack_unity_depth(unity_depth):
+    """Packs a uint8 Unity depth map's channels into one integer code per pixel:
+    code = 992 * (247 - R) + 32 * (247 - G) + (255 - B), such that the encoded
+    depth is code * far / (256 * 31 * 31 - 1). As in the original uint8
+    arithmetic, 247 - R and 247 - G wrap around for values above 247
+
+    Args:
+        unity_depth (np.array): H x W x C uint8 depth map
+
+    Returns:
+        np.array: H x W int32 codes in [0, UNITY_DEPTH_CODES)
+    """
+    code = np.subtract(247, unity_depth[:, :, 0], dtype=np.uint8).astype(np.int32)
+    code *= 992
+    green = np.subtract(247, unity_depth[:, :, 1], dtype=np.uint8).astype(np.int32)
+    code += green * 32
+    code += np.subtract(255, unity_depth[:, :, 2], dtype=np.uint8)
+    return code
+
+
+@lru_cache(maxsize=4)
+def unity_depth_lut(log=True, far=1000):
+    """Depth, or log-depth, of every packed Unity depth code (see
+    pack_unity_depth), computed like decode_unity_depth_t's float32 path so
+    that looking them up gives exactly the same values
+
+    Args:
+        log (bool, optional): log-depth table. Defaults to True.
+        far (int, optional): far parameter of the camera in Unity simulator.
+            Defaults to 1000.
+
+    Returns:
+        torch.Tensor: float32 table of UNITY_DEPTH_CODES values
+    """
+    depth = torch.arange(UNITY_DEPTH_CODES).type(torch.FloatTensor) / (
+        256 * 31 * 31 - 1
+    )
+    depth = depth * far
+    if log:
+        depth = torch.log(depth)
+    return depth
+
+
 def decode_unity_depth_t(unity_depth, log=True, normalize=False, numpy=False, far=1000):
     """Transforms the 3-channel encoded depth map from our Unity simulator to 1-channel depth map
     containing metric depth values.
@@ -204,17 +251,25 @@ def decode_unity_depth_t(unity_depth, log=True, normalize=False, numpy=False, fa
     Returns:
         [torch.Tensor or numpy.array]: decoded depth
     """
-    R = unity_depth[:, :, 0]
-    G = unity_depth[:, :, 1]
-    B = unity_depth[:, :, 2]
-
-    R = ((247 - R) / 8).type(torch.FloatTensor)
-    G = ((247 - G) / 8).type(torch.FloatTensor)
-    B = (255 - B).type(torch.FloatTensor)
-    depth = ((R * 256 * 31 + G * 256 + B).type(torch.FloatTensor)) / (256 * 31 * 31 - 1)
-    depth = (depth * far).unsqueeze(0)
-    if log:
-        depth = torch.log(depth)
+    if unity_depth.dtype == torch.uint8 and unity_depth.device.type == "cpu":
+        # uint8 maps only have UNITY_DEPTH_CODES possible (R, G, B) encodings:
+        # pack them into one integer and look the depth up
+        lut = unity_depth_lut(log, far).numpy()
+        code = pack_unity_depth(unity_depth.numpy())
+        depth = torch.from_numpy(np.take(lut, code)).unsqueeze(0)
+    else:
+        R = unity_depth[:, :, 0]
+        G = unity_depth[:, :, 1]
+        B = unity_depth[:, :, 2]
+        R = ((247 - R) / 8).type(torch.FloatTensor)
+        G = ((247 - G) / 8).type(torch.FloatTensor)
+        B = (255 - B).type(torch.FloatTensor)
+        depth = ((R * 256 * 31 + G * 256 + B).type(torch.FloatTensor)) / (
+            256 * 31 * 31 - 1
+        )
+        depth = (depth * far).unsqueeze(0)
+        if log:
+            depth = torch.log(depth)
     if normalize:
         depth = depth - torch.min(depth)
         depth /= torch.max(depth)
@@ -268,6 +323,30 @@ def slice_batch(batch, slice_size):
     return batch
 
 
+def split_batch(batch, n):
+    """Splits a batch into n micro-batches of (almost) equal sizes
+
+    Args:
+        batch (dict): batch from a loader, with a "domain" list
+        n (int): number of micro-batches, at most the batch's size
+
+    Returns:
+        list: micro-batches with the same keys as batch
+    """
+    size = len(batch["domain"])
+    assert 0 < n <= size
+    bounds = [size * i // n for i in range(n + 1)]
+    return [
+        {
+            k: {task: d[start:end] for task, d in v.items()}
+            if isinstance(v, dict)
+            else v[start:end]
+            for k, v in batch.items()
+        }
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
 def save_tanh_tensor(image, path):
     """Save an image which can be numpy or tensor, 2 or 3 dims (no batch)
     to path.
@@ -342,16 +421,31 @@ def get_num_params(model):
     return total_params
 
 
+def uses_batch_statistics(modules):
+    """Whether the outputs of modules for a sample depend on the other samples
+    of the batch, i.e. they have BatchNorm layers in training mode
+
+    Args:
+        modules (list): torch.nn.Module (or None) to inspect
+
+    Returns:
+        bool: True if a BatchNorm layer normalizes with batch statistics
+    """
+    return any(
+        isinstance(m, torch.nn.modules.batchnorm._BatchNorm)
+        and (m.training or not m.track_running_stats)
+        for module in modules
+        if module is not None
+        for m in module.modules()
+    )
+
+
 def vgg_preprocess(batch):
     """Preprocess batch to use VGG model
     """
-    tensortype = type(batch.data)
     (r, g, b) = torch.chunk(batch, 3, dim=1)
     batch = torch.cat((b, g, r), dim=1)  # convert RGB to BGR
     batch = (batch + 1) * 255 * 0.5  # [-1, 1] -> [0, 255]
-    mean = tensortype(batch.data.size()).cuda()
-    mean[:, 0, :, :] = 103.939
-    mean[:, 1, :, :] = 116.779
-    mean[:, 2, :, :] = 123.680
-    batch = batch.sub(Variable(mean))  # subtract mean
-    return batch
+    # on the batch's device and in its dtype (e.g. bfloat16 with train.amp)
+    mean = batch.new_tensor([103.939, 116.779, 123.680]).view(1, 3, 1, 1)
+    return batch - mean  # subtract mean
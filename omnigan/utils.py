@@ -270,24 +270,30 @@ def get_comet_rest_api_key(path_to_config_file=None):
 
 
 def get_files(dirName):
-    # create a list of file and sub directories
-    files = os.listdir(dirName)
-    all_files = list()
-    for entry in files:
-        fullPath = os.path.join(dirName, entry)
-        if os.path.isdir(fullPath):
-            all_files = all_files + get_files(fullPath)
-        else:
-            all_files.append(fullPath)
+    """Yields the paths of all files in dirName and its sub-directories,
+    walking the tree with os.scandir
+
+    Args:
+        dirName (str): directory to list
 
-    return all_files
+    Yields:
+        str: path to a file
+    """
+    to_visit = [dirName]
+    while to_visit:
+        with os.scandir(to_visit.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    to_visit.append(entry.path)
+                else:
+                    yield entry.path
 
 
 def make_json_file(
     keys,
     addresses,  # for windows user, use "\\" instead of using "/"
     name_of_the_json_file="jsonfile.json",
-    splitter = '/'
+    splitter="/",
 ):
     """
         How to use it?
@@ -298,44 +304,76 @@ def make_json_file(
     '/network/tmp1/ccai/data/munit_dataset/trainA_megadepth_resized/'
     ], 'train_r_resized.json')
 
+    Samples are the files of the first key's folder, matched by name (without
+    extension) with the files of the other folders. They are written as they
+    are matched: as a JSON list, or one sample per line if
+    name_of_the_json_file ends with .jsonl (JSON Lines). Samples missing some
+    files are not written but reported.
+
     Args:
         keys (list): the list of image type like 'x', 'm', 'd', etc.
         addresses (list): the list of the corresponding address of the image type mentioned in keys.
         name_of_the_json_file (str, optional): The name of the output json file. Default to "jsonfile.json"
         splitter (str, optional): The path separator for the current OS. Defaults to '/'.
+
+    Returns:
+        dict: {key: number of samples missing a file for that key}
     """
 
     print("Please Make sure there is a file with the same name in each folder!")
     assert len(keys) == len(addresses), "keys and addresses must have the same length!"
 
-    files = [get_files(addresses[j]) for j in range(len(keys))]
+    def name(file):
+        # the filename without extension
+        return os.path.splitext(file.split(splitter)[-1])[0]
 
-    file_address_map = {
-        keys[j]: {
-            ".".join(file.split(splitter)[-1].split(".")[:-1]): file
-            for file in files[j]
-        }
-        for j in range(len(keys))
-    }
-    # The keys of the file_address_map are like 'x', 'm', 'd'...
-    # The values of the file_address_map are a dictionary whose keys are the
-    # filenames without extension whose values are the path of the filename
-    # e.g. file_address_map =
-    # {'x': {'A': 'path/to/trainA_size_1200/A.png', ...},
-    #  'm': {'A': 'path/to/seg_trainA_size_1200/A.jpg',...}
+    # One pass per key to map file names to paths, e.g.
+    # {'m': {'A': 'path/to/seg_trainA_size_1200/A.jpg',...}
     #  'd': {'A': 'path/to/trainA_megadepth_resized/A.bmp',...}
     # ...}
+    file_address_map = {
+        key: {name(file): file for file in get_files(address)}
+        for key, address in zip(keys[1:], addresses[1:])
+    }
 
-    dicts = []
-    for file in files[0]:
-        filename = file.split(splitter)[-1]  # the filename with 'x' extension
-        filename_ = ".".join(filename.split(".")[:-1])  # the filename without extension
-        tmp_dict = {}
-        for i in range(len(keys)):
-            tmp_dict[keys[i]] = file_address_map[keys[i]][filename_]
-        dicts.append(tmp_dict)
+    missing = {key: 0 for key in keys[1:]}
+    missing_examples = []
+    json_lines = Path(name_of_the_json_file).suffix == ".jsonl"
+    written = 0
     with open(name_of_the_json_file, "w", encoding="utf-8") as outfile:
-        json.dump(dicts, outfile, ensure_ascii=False)
+        if not json_lines:
+            outfile.write("[")
+        for file in get_files(addresses[0]):
+            sample = {keys[0]: file}
+            file_name = name(file)
+            for key, names in file_address_map.items():
+                if file_name in names:
+                    sample[key] = names[file_name]
+                else:
+                    missing[key] += 1
+            if len(sample) < len(keys):
+                if len(missing_examples) < 10:
+                    missing_examples.append(file)
+                continue
+            if json_lines:
+                outfile.write(json.dumps(sample, ensure_ascii=False) + "\n")
+            else:
+                if written:
+                    outfile.write(", ")
+                outfile.write(json.dumps(sample, ensure_ascii=False))
+            written += 1
+        if not json_lines:
+            outfile.write("]")
+
+    print("{} samples written to {}".format(written, name_of_the_json_file))
+    if any(missing.values()):
+        print(
+            "Samples missing files: {}. e.g. {}".format(
+                ", ".join("{} {}".format(n, key) for key, n in missing.items() if n),
+                ", ".join(missing_examples),
+            )
+        )
+    return missing
 
 
 def sum_dict(dict1, dict2):
@@ -1,85 +1,211 @@
+"""Builds json lines file lists (one {task: path} sample per line) from a data
+folder with a sub-folder per category, samples being matched by file name.
+
+Category folders are scanned in parallel into sorted file name lists which are
+merged to stream the samples to the output files. Existing lists are updated
+incrementally: their samples are kept in order, samples whose files were
+removed are dropped and new ones appended.
+
+With --train_size, samples are split between train.jsonl and val.jsonl
+according to a hash of their name so that a sample always stays in the same
+split, without having to hold the list of all samples to draw the split.
+"""
 import argparse
-import glob
+import hashlib
+import heapq
 import os
-import random
-import json
-
-random.seed(1332)
-
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--path",
-    default="./example_data/flood_real_dataset/",
-    type=str,
-    help="Path to the data folder, a folder for each category",
-)
-parser.add_argument(
-    "--train_size",
-    default=0,
-    type=int,
-    help="Size of the train set in percentage, default no split",
-)
-opts = parser.parse_args()
-data_path = opts.path
-categories = {}
-sample_list = {}
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+
+from omnigan.manifest import read_json_lines, write_json_lines
 
 # Mapping data category (~folder name) to json index
 mapping = {"Segmentation": "s", "Depth": "d", "Data": "x", "Height": "h"}
 
-# List the files for every category
-if os.path.exists(data_path):
-    for key in mapping.keys():
-        if os.path.exists(data_path + key):
-            categories[key] = [f for f in glob.glob(data_path + key + "/*")]
-        else:
-            raise ValueError(
-                "The folder {} doesn't exist add it or change the mapping".format(key)
-            )
-else:
-    raise ValueError("Not a correct path")
-
-# Build dict with samples as keys and dicts of datapath as values
-for category in categories.keys():
-    for sample in categories[category]:
-        sample_with_extension = os.path.basename(sample)
-        sample_name = os.path.splitext(os.path.basename(sample_with_extension))[0]
-        if sample_name not in sample_list.keys():
-            sample_list[sample_name] = {}
-        sample_list[sample_name][mapping[category]] = (
-            data_path + category + "/" + sample_with_extension
-        )
 
+def parsed_args():
+    """Parse and returns command-line args
 
-# If we want to split the dataset in train and validation set
-if opts.train_size > 0:
-    train_set = {}
-    # Select indexes for the sampling
-    train_keys = random.sample(
-        sample_list.keys(), int(len(sample_list) * opts.train_size / 100)
+    Returns:
+        argparse.Namespace: the parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--path",
+        default="./example_data/flood_real_dataset/",
+        type=str,
+        help="Path to the data folder, a folder for each category",
+    )
+    parser.add_argument(
+        "--train_size",
+        default=0,
+        type=int,
+        help="Size of the train set in percentage, default no split",
+    )
+    parser.add_argument(
+        "--output_dir",
+        default="./example_data",
+        type=str,
+        help="Where to write data.jsonl, or train.jsonl and val.jsonl",
     )
-    print("Using {} images as train set".format(len(train_keys)))
-    val_keys = list(sample_list.keys() - train_keys)
-    print("Using {} images as val set".format(len(val_keys)))
+    parser.add_argument(
+        "--num_threads", default=8, type=int, help="Folders scanned in parallel",
+    )
+    return parser.parse_args()
+
+
+def scan_category(folder):
+    """Lists the files of a category folder, sorted by sample name so that
+    categories can be merged without building a dict of all the samples
+
+    Args:
+        folder (str): path to the folder
+
+    Returns:
+        list: sorted (sample name, file name) tuples
+    """
+    with os.scandir(folder) as entries:
+        files = [
+            (os.path.splitext(entry.name)[0], entry.name)
+            for entry in entries
+            if not entry.is_dir()
+        ]
+    files.sort()
+    return files
+
+
+def iter_samples(data_path, categories):
+    """Yields the samples of the category folders in sample name order, merging
+    their sorted file lists
+
+    Args:
+        data_path (str): path to the data folder
+        categories (dict): {category: scan_category(category folder)}
+
+    Yields:
+        tuple: (sample name, {task: path})
+    """
+    names = list(categories)
+
+    def stream(k):
+        # tasks are ordered like the categories, as in find_sample
+        for name, file_name in categories[names[k]]:
+            yield name, k, file_name
+
+    streams = [stream(k) for k in range(len(names))]
+    for name, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        yield name, {
+            mapping[names[k]]: os.path.join(data_path, names[k], file_name)
+            for _, k, file_name in group
+        }
 
-    for key in train_keys:
-        train_set[key] = sample_list[key]
 
-    for key in train_keys:
-        sample_list.pop(key)
+def find_sample(data_path, categories, name):
+    """Sample called name in the scanned categories, as yielded by iter_samples
 
-    val_set = sample_list
-    print("Creating JSON file ...")
+    Returns:
+        dict: {task: path}, empty if no file has this name
+    """
+    sample = {}
+    for category, files in categories.items():
+        i = bisect_left(files, (name,))
+        while i < len(files) and files[i][0] == name:
+            sample[mapping[category]] = os.path.join(data_path, category, files[i][1])
+            i += 1
+    return sample
 
-    with open("./example_data/train.json", "w") as f:
-        json.dump(train_set, f, indent=4, sort_keys=True)
 
-    with open("./example_data/val.json", "w") as f:
-        json.dump(val_set, f, indent=4, sort_keys=True)
+def split_of(name, train_size):
+    """Deterministic split of a sample from its name
 
-else:
-    print("The dataset contains {0} samples".format(len(sample_list)))
-    print("Creating JSON file ..")
+    Args:
+        name (str): sample name
+        train_size (int): percentage of samples in the train split, 0 for no split
 
-    with open("./example_data/data.json", "w") as f:
-        json.dump(sample_list, f, indent=4, sort_keys=True)
+    Returns:
+        str: "data" if train_size is 0, "train" or "val" otherwise
+    """
+    if train_size <= 0:
+        return "data"
+    bucket = int(hashlib.sha1(name.encode()).hexdigest()[:8], 16) % 100
+    return "train" if bucket < train_size else "val"
+
+
+def sample_name(sample):
+    return os.path.splitext(os.path.basename(next(iter(sample.values()))))[0]
+
+
+def update_list(list_path, data_path, categories, split, train_size):
+    """Writes the samples of a split to list_path, keeping the unchanged samples
+    of an existing list in order and appending new ones. Samples are streamed
+    from the scanned categories, only the names of the kept ones are held
+
+    Args:
+        list_path (pathlib.Path): .jsonl file list to create or update
+        data_path (str): path to the data folder
+        categories (dict): {category: scan_category(category folder)}
+        split (str): split to write, see split_of
+        train_size (int): percentage of samples in the train split
+
+    Returns:
+        tuple: (kept, removed, added) numbers of samples
+    """
+    kept = set()
+    counts = {"removed": 0}
+
+    def merged():
+        if list_path.exists():
+            for sample in read_json_lines(list_path):
+                name = sample_name(sample)
+                if (
+                    name not in kept
+                    and split_of(name, train_size) == split
+                    and find_sample(data_path, categories, name) == sample
+                ):
+                    kept.add(name)
+                    yield sample
+                else:
+                    # removed files or changed sample, which is appended again
+                    counts["removed"] += 1
+        for name, sample in iter_samples(data_path, categories):
+            if name not in kept and split_of(name, train_size) == split:
+                yield sample
+
+    total = write_json_lines(merged(), list_path)
+    return len(kept), counts["removed"], total - len(kept)
+
+
+if __name__ == "__main__":
+    opts = parsed_args()
+    data_path = opts.path
+
+    if not os.path.exists(data_path):
+        raise ValueError("Not a correct path")
+    for category in mapping:
+        if not os.path.exists(os.path.join(data_path, category)):
+            raise ValueError(
+                "The folder {} doesn't exist add it or change the mapping".format(
+                    category
+                )
+            )
+
+    # List the files for every category
+    with ThreadPoolExecutor(opts.num_threads) as executor:
+        folders = [os.path.join(data_path, category) for category in mapping]
+        categories = dict(zip(mapping, executor.map(scan_category, folders)))
+
+    output_dir = Path(opts.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for split in ["data"] if opts.train_size <= 0 else ["train", "val"]:
+        list_path = output_dir / "{}.jsonl".format(split)
+        kept, removed, added = update_list(
+            list_path, data_path, categories, split, opts.train_size
+        )
+        print(
+            "{}: {} samples ({} kept, {} removed, {} added)".format(
+                list_path, kept + added, kept, removed, added
+            )
+        )
@@ -1,11 +1,58 @@
 import argparse
+import io
+import os
 import sys
+import tempfile
 from pathlib import Path
 
+import numpy as np
+import torch
 from addict import Dict
+from PIL import Image
 
 sys.path.append(str(Path(__file__).parent.parent.resolve()))
-from omnigan.data import OmniListDataset, get_all_loaders, get_loader
+from omnigan.data import (
+    AspectRatioBucketSampler,
+    OmniListDataset,
+    OmniShardDataset,
+    RepeatedAugmentationSampler,
+    ResidentLoader,
+    get_all_loaders,
+    get_bucket_sizes,
+    get_dataset,
+    materialize_dataset,
+    get_loader,
+    get_multi_domain_loader,
+    pack_mask,
+    read_packed_mask,
+    tensor_loader,
+    write_depth_store,
+)
+from omnigan.manifest import SamplesManifest, load_manifest, write_json_lines
+from omnigan.affinity import (
+    available_cpus,
+    format_cpulist,
+    get_affinity_layout,
+    parse_cpulist,
+    set_trainer_affinity,
+)
+from omnigan.autotune import measure, train_batches, train_datasets
+from omnigan.shards import compile_shards
+from omnigan.cache import TensorCache
+from omnigan.transforms import (
+    BatchAugment,
+    CenterCrop,
+    FusedGeometric,
+    Normalize,
+    RandomCrop,
+    RandomHorizontalFlip,
+    Resize,
+    fuse_geometric,
+    get_conf_transforms,
+    scale_transforms,
+    split_deterministic,
+    unfuse_geometric,
+)
 from omnigan.utils import load_test_opts
 from omnigan.tutils import transforms_string
 
@@ -96,3 +143,339 @@ if __name__ == "__main__":
 
         if i > 5:
             break
+
+    # -----------------------------------------
+    # -----  Test shards match file lists  -----
+    # -----------------------------------------
+    with tempfile.TemporaryDirectory() as shards_dir:
+        ds = loaders["train"]["r"].dataset
+        compile_shards(ds.samples_paths, Path(shards_dir) / "train_r", shard_size=1)
+        shard_opts = Dict(opts.to_dict())
+        shard_opts.data.shards.path = shards_dir
+        sds = OmniShardDataset("train", "r", shard_opts, transform=ds.transform)
+        assert len(sds) == len(ds)
+        # the index is memory-mapped, not loaded as Python objects
+        assert isinstance(sds.reader.index["offset"], np.memmap)
+        for i in range(min(len(ds), 3)):
+            # same random transforms for both items
+            np.random.seed(i)
+            item = ds[i]
+            np.random.seed(i)
+            shard_item = sds[i]
+            assert item["paths"] == shard_item["paths"]
+            for task, tensor in item["data"].items():
+                assert torch.equal(tensor, shard_item["data"][task])
+        print("Shards ok.")
+
+    # ----------------------------------
+    # -----  Test the tensor cache  -----
+    # ----------------------------------
+    with tempfile.TemporaryDirectory() as cache_dir:
+        ds = loaders["train"]["r"].dataset
+        cached, others = split_deterministic(ds.transform.transforms)
+        cache = TensorCache(cache_dir, cached)
+        paths = ds.samples_paths[0]
+        for _ in range(2):
+            # first iteration writes to the cache, second one reads from it
+            for task, path in paths.items():
+                tensor = cache.load(path, task, ds.domain, tensor_loader)
+                assert tensor.dtype == torch.float32
+        print("Tensor cache ok.")
+
+    # ------------------------------------------
+    # -----  Test batch-level augmentation  -----
+    # ------------------------------------------
+    _, random_transforms = split_deterministic(get_conf_transforms(opts))
+    augment = BatchAugment(random_transforms)
+    augmented = augment(batch["data"])
+    for task, tensor in augmented.items():
+        print(task, tensor.shape, tensor.dtype)
+        assert tensor.shape[:2] == batch["data"][task].shape[:2]
+        assert tensor.dtype == batch["data"][task].dtype
+    print("Batch augmentation ok.")
+
+    # --------------------------------------------------
+    # -----  Test the unified multi-domain loader  -----
+    # --------------------------------------------------
+    multi_loader = get_multi_domain_loader(
+        {domain: loader.dataset for domain, loader in loaders["train"].items()}, opts
+    )
+    multi_batch_tuple = next(iter(multi_loader))
+    assert len(multi_batch_tuple) == len(loaders["train"])
+    for domain, multi_batch in zip(loaders["train"], multi_batch_tuple):
+        assert set(multi_batch["domain"]) == {domain}
+        print(domain, multi_batch["data"]["x"].shape)
+    print("Multi-domain loader ok.")
+
+    # -----------------------------------
+    # -----  Test bit-packed masks  -----
+    # -----------------------------------
+    mask = (np.random.rand(37, 51) > 0.5).astype(np.uint8)
+    packed = io.BytesIO()
+    np.savez(packed, **pack_mask(mask * 255))
+    packed.seek(0)
+    assert np.array_equal(read_packed_mask(packed), mask)
+    packed.seek(0)
+    window = (3, 5, 20, 30)
+    assert np.array_equal(read_packed_mask(packed, window=window), mask[3:23, 5:35])
+    print("Packed masks ok.")
+
+    # ---------------------------------------
+    # -----  Test the samples manifest  -----
+    # ---------------------------------------
+    samples = [{"x": "a/0.jpg", "m": "b/0.png"}, {"x": "a/é.jpg"}]
+    manifest = SamplesManifest.from_samples(samples)
+    assert len(manifest) == 2
+    assert list(manifest) == samples
+    assert list(manifest.column("m")) == ["b/0.png"]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        ds = loaders["train"]["r"].dataset
+        for _ in range(2):
+            # first call converts the list, second one memory-maps the conversion
+            cached = load_manifest(ds.file_list_path, ds.tasks, cache_dir)
+            assert list(cached) == list(ds.samples_paths)
+        jsonl_path = Path(cache_dir) / "samples.jsonl"
+        write_json_lines(samples, jsonl_path)
+        assert list(load_manifest(jsonl_path, cache=cache_dir)) == samples
+    print("Manifest ok.")
+
+    # ------------------------------------------------
+    # -----  Test the samples check fingerprint  -----
+    # ------------------------------------------------
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        samples = []
+        for i in range(3):
+            sample = {}
+            for task, ext in [("x", ".jpg"), ("m", ".png")]:
+                (tmp / task).mkdir(exist_ok=True)
+                sample[task] = str(tmp / task / "{}{}".format(i, ext))
+                Path(sample[task]).touch()
+            samples.append(sample)
+        write_json_lines(samples, tmp / "list.jsonl")
+        check_opts = Dict(opts.to_dict())
+        check_opts.data.files.train.r = str(tmp / "list.jsonl")
+        check_opts.data.check_samples.cache = str(tmp / "validated")
+        check_opts.data.manifest.cache = None
+        ds = OmniListDataset("train", "r", check_opts)
+        fingerprint = ds.fingerprint_path(ds.sample_dirs())
+        assert fingerprint.exists()
+        # removing a listed file changes its directory's mtime
+        Path(samples[2]["m"]).unlink()
+        assert ds.fingerprint_path(ds.sample_dirs()) != fingerprint
+        try:
+            OmniListDataset("train", "r", check_opts)
+            checked = False
+        except AssertionError:
+            checked = True
+        assert checked, "the missing file should be detected"
+    print("Samples check fingerprint ok.")
+
+    # -------------------------------
+    # -----  Test depth stores  -----
+    # -------------------------------
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        samples = []
+        for i in range(2):
+            sample = {}
+            for task, ext in [("x", ".jpg"), ("d", ".png")]:
+                (tmp / task).mkdir(exist_ok=True)
+                sample[task] = str(tmp / task / "{}{}".format(i, ext))
+                arr = np.random.randint(0, 256, (32, 48, 3), dtype=np.uint8)
+                Image.fromarray(arr).save(sample[task])
+            samples.append(sample)
+        write_json_lines(samples, tmp / "list.jsonl")
+        store_opts = Dict(opts.to_dict())
+        store_opts.tasks = ["d"]
+        store_opts.data.files.train.s = str(tmp / "list.jsonl")
+        store_opts.data.check_samples.cache = None
+        store_opts.data.manifest.cache = None
+        decoded = OmniListDataset("train", "s", store_opts).loader(
+            samples[1]["d"], "d", "s"
+        )
+        write_depth_store(samples[0]["d"])
+        # stores are only used if every sample has one
+        assert not OmniListDataset("train", "s", store_opts).depth_store
+        write_depth_store(samples[1]["d"])
+        ds = OmniListDataset("train", "s", store_opts)
+        assert ds.depth_store
+        stored = ds.loader(samples[1]["d"], "d", "s")
+        assert stored.shape == decoded.shape
+        assert torch.allclose(stored, decoded, atol=1e-3)
+    print("Depth stores ok.")
+
+    # ---------------------------------------
+    # -----  Test aspect ratio buckets  -----
+    # ---------------------------------------
+    default_sizes = get_bucket_sizes(
+        opts.data.buckets.pixels,
+        opts.data.buckets.multiple or 2 ** opts.gen.p.spade_n_up,
+        opts.data.buckets.max_ratio,
+    )
+    assert len(default_sizes) > 1
+    try:
+        # only 256 x 256 is 65536 pixels with dims multiple of 128
+        get_bucket_sizes(256 * 256, 128)
+        single = True
+    except ValueError:
+        single = False
+    assert not single, "a single bucket should raise"
+    sizes = get_bucket_sizes(256 * 256, 32)
+    assert all(h % 32 == 0 and w % 32 == 0 for h, w in sizes)
+    bucket_of = np.random.randint(0, len(sizes), 50)
+    sampler = AspectRatioBucketSampler(bucket_of, 4)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for b in batches for i in b) == list(range(50))
+    assert all(len(set(bucket_of[b])) == 1 for b in batches)
+    h, w = sizes[0]
+    scaled = scale_transforms(get_conf_transforms(opts), (h, w))
+    scaled_item = {"x": torch.rand(1, 3, 300, 400)}
+    for t in scaled:
+        scaled_item = t(scaled_item)
+    assert scaled_item["x"].shape[-2:] == (h, w)
+    print("Aspect ratio buckets ok.")
+
+    # ----------------------------------------
+    # -----  Test repeated augmentation  -----
+    # ----------------------------------------
+    sampler = RepeatedAugmentationSampler(10, 3)
+    indices = list(sampler)
+    assert len(indices) == len(sampler) == 10
+    assert all(len(set(indices[k : k + 3])) == 1 for k in range(0, 9, 3))
+    assert len(set(indices)) == 4
+    rep_opts = Dict(opts.to_dict())
+    rep_opts.data.loaders.repeated_augmentations = 2
+    rep_opts.data.loaders.batch_size = 2
+    rep_loader = get_loader("train", "r", rep_opts)
+    assert isinstance(rep_loader.sampler, RepeatedAugmentationSampler)
+    batch = next(iter(rep_loader))
+    assert batch["paths"]["x"][0] == batch["paths"]["x"][1]
+    assert get_loader("val", "r", rep_opts).dataset.repeats == 1
+    print("Repeated augmentation ok.")
+
+    # ------------------------------------------------
+    # -----  Test the loaders autotuner measure  -----
+    # ------------------------------------------------
+    tune_opts = Dict(opts.to_dict())
+    tune_opts.data.loaders.num_workers = 0
+    samples_per_s, wait = measure(
+        train_batches(train_datasets(tune_opts), tune_opts), 2, warmup=1
+    )
+    assert samples_per_s > 0 and wait > 0
+    print("Autotuner measure ok.")
+
+    # ------------------------------------
+    # -----  Test per-stage timings  -----
+    # ------------------------------------
+    timed_opts = Dict(opts.to_dict())
+    timed_opts.data.loaders.timings = True
+    timings = get_dataset("val", "r", timed_opts)[0]["timings"]
+    assert timings["worker"] == -1
+    assert {"read_x", "decode_x"} <= set(timings)
+    assert all(t >= 0 for s, t in timings.items() if s != "worker")
+    print("Timings ok.")
+
+    # ---------------------------------------------
+    # -----  Test fused geometric transforms  -----
+    # ---------------------------------------------
+    geometric = [RandomHorizontalFlip(0.5), Resize(256), RandomCrop(224)]
+    fused = fuse_geometric(geometric + [Resize(256), Normalize()])
+    assert isinstance(fused[0], FusedGeometric) and len(fused) == 2
+    sample = {
+        "x": torch.randint(0, 256, (1, 3, 256, 300), dtype=torch.uint8),
+        "m": torch.randint(0, 2, (1, 1, 256, 300), dtype=torch.uint8),
+    }
+    for seed in range(4):
+        # crops of the decoded data are sliced: same output as sequentially
+        np.random.seed(seed)
+        expected = sample
+        for t in [geometric[0], geometric[2]]:
+            expected = t(expected)
+        np.random.seed(seed)
+        out = FusedGeometric([geometric[0], geometric[2]])(sample)
+        assert all(torch.equal(out[task], expected[task]) for task in sample)
+    out = fused[0](sample)
+    assert out["x"].shape[-2:] == (256, 256) and out["m"].dtype == torch.uint8
+    sample["d"] = torch.rand(1, 1, 253, 377).to(torch.float16)
+    sample["s"] = torch.randint(0, 10, (1, 1, 253, 377))
+    sample["x"] = torch.randint(0, 256, (1, 3, 253, 377), dtype=torch.uint8)
+    sample["m"] = torch.randint(0, 2, (1, 1, 253, 377), dtype=torch.uint8)
+    chains = [
+        geometric + [Resize(256)],
+        [Resize(256), Resize((200, 333))],
+        [RandomHorizontalFlip(0.5), Resize((200, 333)), RandomCrop(180)]
+        + [RandomHorizontalFlip(0.5), Resize(256)],
+        [Resize(300), CenterCrop(224), Resize(256)],
+    ]
+    for chain in chains:
+        for seed in range(4):
+            # nearest-resized tasks are exact, images are interpolated once
+            np.random.seed(seed)
+            expected = sample
+            for t in chain:
+                expected = t(expected)
+            np.random.seed(seed)
+            out = FusedGeometric(chain)(sample)
+            assert all(torch.equal(out[task], expected[task]) for task in "mds")
+            assert out["x"].shape == expected["x"].shape
+    assert split_deterministic(fused)[0] == [geometric[1]]
+    print("Fused transforms ok.")
+
+    # ---------------------------------------
+    # -----  Test core affinity layout  -----
+    # ---------------------------------------
+    assert parse_cpulist("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpulist([0, 1, 2, 3, 8, 10, 11]) == "0-3,8,10-11"
+    layout = get_affinity_layout(opts)
+    assert layout["trainer"] and layout["workers"]
+    if len(available_cpus()) > 1:
+        assert not set(layout["trainer"]) & set(layout["workers"])
+    aff_opts = Dict(opts.to_dict())
+    aff_opts.data.loaders.affinity.use = True
+    aff_opts.data.loaders.num_workers = 1
+    aff_opts.data.val.resident = False
+    layout = get_affinity_layout(aff_opts)
+    cpus, num_threads = available_cpus(), torch.get_num_threads()
+    set_trainer_affinity(layout)
+    try:
+        # workers get the cores of the layout computed before pinning the trainer
+        pinned_loaders = get_all_loaders(aff_opts, layout)
+        for loader in pinned_loaders["train"].values():
+            assert loader.worker_init_fn.args == (layout["workers"],)
+            next(iter(loader))
+    finally:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(num_threads)
+    print("Affinity ok.")
+
+    # -------------------------------------------
+    # -----  Test resident validation sets  -----
+    # -------------------------------------------
+    val_opts = Dict(opts.to_dict())
+    val_opts.data.val.deterministic = True
+    val_ds = get_dataset("val", "r", val_opts)
+    assert not any(
+        isinstance(t, (RandomCrop, RandomHorizontalFlip))
+        and not isinstance(t, CenterCrop)
+        for t in unfuse_geometric(val_ds.transform.transforms)[0]
+    )
+    with tempfile.TemporaryDirectory() as val_dir:
+        for root in [None, val_dir, val_dir]:
+            resident = materialize_dataset(val_ds, val_opts, root)
+            assert len(resident) == len(val_ds)
+            for task, tensor in val_ds[1]["data"].items():
+                assert torch.equal(resident[1]["data"][task], tensor)
+            batch = next(iter(ResidentLoader(resident, 2)))
+            assert batch["data"]["x"].shape[0] == 2
+            assert batch["paths"]["x"][1] == val_ds[1]["paths"]["x"]
+        # other tasks are stored separately
+        x_opts = Dict(val_opts.to_dict())
+        x_opts.tasks = []
+        x_ds = get_dataset("val", "r", x_opts)
+        resident = materialize_dataset(x_ds, x_opts, val_dir)
+        assert set(resident[1]["data"]) == {"x"}
+        assert len(list(Path(val_dir).iterdir())) == 2
+    print("Resident validation ok.")
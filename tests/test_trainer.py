@@ -1,10 +1,15 @@
 import argparse
 import sys
+from copy import deepcopy
 from pathlib import Path
 
+import torch
+from addict import Dict
+
 sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from omnigan.norms import power_iteration_per_step
 from omnigan.trainer import Trainer
-from omnigan.utils import load_test_opts
+from omnigan.utils import flatten_opts, load_test_opts
 from run import print_header
 
 parser = argparse.ArgumentParser()
@@ -29,11 +34,16 @@ if __name__ == "__main__":
     # -----  Test Config  -----
     # -------------------------
     test_setup = True
+    test_display_sets = True
     test_get_representation_loss = True
     test_get_translation_loss = True
     test_get_classifier_loss = True
     test_update_g = True
     test_update_d = False
+    test_mixed_precision = True
+    test_latent_cache = True
+    test_fuse_domains = True
+    test_accumulate_steps = True
     test_full_step = True
 
     # ----------------------------------
@@ -43,6 +53,41 @@ if __name__ == "__main__":
         print_header("test_setup")
         trainer.setup()
 
+    # ---------------------------------
+    # -----  Test display images  -----
+    # ---------------------------------
+    if test_display_sets:
+        print_header("test_display_sets")
+        for mode, domain_dict in trainer.loaders.items():
+            for domain in domain_dict:
+                batch = trainer.display_images.get(mode, domain)
+                items = list(trainer.display_images.items(mode, domain))
+                assert len(items) == len(batch["domain"])
+                assert all(item["x"].shape[0] == 1 for item in items)
+                assert batch["data"]["x"].device.type == trainer.device.type
+
+        # display sets are built in the main thread once the workers exist
+        worker_opts = Dict(opts.to_dict())
+        worker_opts.data.loaders.num_workers = 2
+        worker_opts.output_path = None  # build the sets instead of loading them
+        worker_trainer = Trainer(worker_opts)
+        worker_trainer.setup()
+        assert worker_trainer.display_images.sets is None
+        next(iter(worker_trainer.train_loaders))
+        for mode, domain_dict in worker_trainer.loaders.items():
+            for domain in domain_dict:
+                assert worker_trainer.display_images.get(mode, domain) is not None
+        del worker_trainer
+
+        # saved sets are only loaded for the same file lists and transforms
+        sources = trainer.display_images.sources()
+        for mode, domain_dict in trainer.loaders.items():
+            for domain, loader in domain_dict.items():
+                file_list, mtime, transforms = sources[mode][domain]
+                assert Path(file_list) == Path(loader.dataset.file_list_path).resolve()
+                assert transforms == repr(loader.dataset.transform.transforms)
+        print("ok.")
+
     # ----------------------------------------------------
     # -----  Test trainer.get_masker_loss()  -----
     # ----------------------------------------------------
@@ -170,6 +215,115 @@ if __name__ == "__main__":
         trainer.losses["D"].flip_prob = 1.0
         trainer.update_d(multi_domain_batch)
 
+    # ----------------------------------
+    # -----  Test mixed precision  -----
+    # ----------------------------------
+    if test_mixed_precision:
+        print_header("test_mixed_precision")
+        trainer.amp_dtype = torch.bfloat16
+        with trainer.autocast():
+            g_loss = trainer.get_g_loss(multi_domain_batch)
+        assert g_loss.dtype == torch.float32
+        assert torch.isfinite(g_loss)
+        trainer.logger.global_step = 0
+        trainer.update_g(multi_domain_batch)
+        assert all(p.dtype == torch.float32 for p in trainer.G.parameters())
+        if "extra" in trainer.opts.gen.opt.optimizer.lower():
+            # an odd step without extrapolation (e.g. skipped because of
+            # non-finite float16 gradients) extrapolates again
+            trainer.g_opt.step()
+            trainer.logger.global_step = 1
+            trainer.update_g(multi_domain_batch)
+            assert trainer.g_opt.params_copy
+            trainer.logger.global_step = 2
+            trainer.update_g(multi_domain_batch)
+            trainer.logger.global_step = 3
+            trainer.update_g(multi_domain_batch)
+            assert not trainer.g_opt.params_copy
+        trainer.amp_dtype = None
+        print("ok.")
+
+    # -------------------------------
+    # -----  Test latent cache  -----
+    # -------------------------------
+    if test_latent_cache:
+        print_header("test_latent_cache")
+        trainer.update_g(multi_domain_batch)
+        for domain, batch in multi_domain_batch.items():
+            if domain == "rf":
+                continue
+            cached = trainer.latents[domain]
+            assert cached["x"] is batch["data"]["x"]
+            assert not cached["z"].requires_grad
+            # D and C reuse G's latent vectors
+            z = trainer.encode(domain, batch["data"]["x"], detach=True)
+            assert z.data_ptr() == cached["z"].data_ptr()
+            # G losses compute them again, with gradients
+            z = trainer.encode(domain, batch["data"]["x"])
+            assert z.requires_grad
+        print("ok.")
+
+    # --------------------------------
+    # -----  Test fused domains  -----
+    # --------------------------------
+    if test_fuse_domains:
+        print_header("test_fuse_domains")
+        # spectral norms' power iteration runs once per step, as in run_epoch
+        state = deepcopy(trainer.G.state_dict())
+        task_losses = []
+        states = []
+        for fuse in [False, True]:
+            trainer.G.load_state_dict(state)
+            power_iteration_per_step(trainer.G)
+            trainer.fuse_domains = fuse
+            trainer.latents = {}
+            trainer.get_masker_loss(multi_domain_batch)
+            task_losses.append(flatten_opts(trainer.logger.losses.generator.task_loss))
+            states.append(deepcopy(trainer.G.state_dict()))
+        assert task_losses[0].keys() == task_losses[1].keys()
+        for key, value in task_losses[0].items():
+            assert abs(value - task_losses[1][key]) <= 1e-5 * max(1, abs(value)), key
+        assert all(torch.allclose(states[0][k], states[1][k]) for k in states[0])
+        trainer.fuse_domains = False
+        print("ok.")
+
+    # ----------------------------------------
+    # -----  Test gradient accumulation  -----
+    # ----------------------------------------
+    if test_accumulate_steps:
+        print_header("test_accumulate_steps")
+        trainer.accumulate_steps = 2
+        steps = [s["step"] for s in trainer.g_opt.state.values()]
+        trainer.update_g(multi_domain_batch)
+        micro_batches = trainer.micro_batches(multi_domain_batch)
+        assert len(micro_batches) == 2
+        for domain, batch in multi_domain_batch.items():
+            sizes = [len(b[domain]["domain"]) for b, _, _ in micro_batches]
+            assert sum(sizes) == len(batch["domain"])
+            for (b, _, _), n in zip(micro_batches, sizes):
+                assert b[domain]["data"]["x"].shape[0] == n
+        # a single optimizer step for all micro-batches
+        assert [s["step"] for s in trainer.g_opt.state.values()] == [
+            n + 1 for n in steps
+        ]
+
+        # uneven split: micro-batches of 1 and 2 samples weigh 1 / 3 and 2 / 3
+        def take(batch, n):
+            # n samples of batch, repeated if needed
+            if isinstance(batch, dict):
+                return {k: take(v, n) for k, v in batch.items()}
+            repeats = -(-n // len(batch))
+            if isinstance(batch, torch.Tensor):
+                return torch.cat([batch] * repeats)[:n]
+            return (list(batch) * repeats)[:n]
+
+        uneven_batch = {d: take(b, 3) for d, b in multi_domain_batch.items()}
+        weights = [w for _, _, w in trainer.micro_batches(uneven_batch)]
+        assert abs(weights[0] - 1 / 3) < 1e-6 and abs(weights[1] - 2 / 3) < 1e-6
+        trainer.update_g(uneven_batch)
+        trainer.accumulate_steps = 1
+        print("ok.")
+
     # -----------------------------------
     # -----  Test full update step  -----
     # -----------------------------------
@@ -1,10 +1,12 @@
 import argparse
 import os
 import sys
+import tempfile
 import uuid
 from pathlib import Path
 
 import addict
+import torch
 
 sys.path.append(str(Path(__file__).parent.parent.resolve()))
 from omnigan.data import get_all_loaders
@@ -13,8 +15,9 @@ from omnigan.utils import (
     flatten_opts,
     get_increased_path,
     load_test_opts,
+    make_json_file,
 )
-from omnigan.tutils import domains_to_class_tensor
+from omnigan.tutils import decode_unity_depth_t, domains_to_class_tensor
 from run import print_header
 
 
@@ -91,3 +94,34 @@ if __name__ == "__main__":
         "f": 5,
     }
     print("ok.")
+
+    # ------------------------------------------
+    # -----  Testing decode_unity_depth_t  -----
+    # ------------------------------------------
+    print_header("test_decode_unity_depth_t")
+    unity_depth = torch.randint(0, 248, (64, 64, 3), dtype=torch.uint8)
+    # uint8 maps use the lookup table, float maps the arithmetic decoding
+    decoded = decode_unity_depth_t(unity_depth, log=True, normalize=True)
+    expected = decode_unity_depth_t(unity_depth.float(), log=True, normalize=True)
+    assert decoded.shape == (1, 64, 64)
+    assert torch.allclose(decoded, expected)
+    print("ok.")
+
+    # ------------------------------------
+    # -----  Testing make_json_file  -----
+    # ------------------------------------
+    print_header("test_make_json_file")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for task, ext in [("x", ".jpg"), ("m", ".png")]:
+            (tmp / task / "sub").mkdir(parents=True)
+            for i in range(3):
+                (tmp / task / "sub" / "{}{}".format(i, ext)).touch()
+        (tmp / "x" / "3.jpg").touch()
+        missing = make_json_file(
+            ["x", "m"], [str(tmp / "x"), str(tmp / "m")], str(tmp / "list.jsonl")
+        )
+        assert missing == {"m": 1}
+        with open(tmp / "list.jsonl") as f:
+            assert len(f.readlines()) == 3
+    print("ok.")
@@ -7,6 +7,7 @@ from addict import Dict
 from comet_ml import Experiment
 from omegaconf import OmegaConf
 
+from omnigan.autotune import reuse_autotuned
 from omnigan.trainer import Trainer
 
 from omnigan.utils import env_to_path, flatten_opts, get_increased_path, load_opts
@@ -65,8 +66,10 @@ def main(opts):
 
         # Save config file
         # TODO what if resuming? re-dump?
+        if opts.train.resume and reuse_autotuned(opts):
+            print("Reusing the autotuned loaders options of", opts.output_path)
         with (Path(opts.output_path) / "opts.yaml").open("w") as f:
-            yaml.safe_dump(opts.to_dict())
+            yaml.safe_dump(opts.to_dict(), f)
 
         if not args.no_comet:
             # ----------------------------------